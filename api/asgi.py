@@ -0,0 +1,60 @@
+import os
+from dotenv import load_dotenv
+
+# Before the routes and utils imports, which read their settings at import time
+load_dotenv()
+
+from contextlib import asynccontextmanager
+from a2wsgi import WSGIMiddleware
+from starlette.applications import Starlette
+from starlette.middleware import Middleware
+from starlette.middleware.cors import CORSMiddleware
+from starlette.routing import Mount, Route
+from routes.chat_generation_async import generate_code_chat_async
+from run import app as flask_app
+from utils.llm_clients import aclose_clients
+
+# Threads for the routes still served by the Flask app (renders, jobs, media)
+ASGI_WSGI_THREADS = int(os.getenv("ASGI_WSGI_THREADS", "32"))
+
+
+@asynccontextmanager
+async def lifespan(app):
+    yield
+    # Close the pooled model clients on the loop they were created on
+    await aclose_clients()
+
+
+def create_asgi_app():
+    """
+    Serves the API from an asyncio event loop: the chat endpoint runs natively
+    async, and every other route is handed to the Flask app on a thread pool.
+    """
+    return Starlette(
+        routes=[
+            Route(
+                "/v1/chat/generation",
+                generate_code_chat_async,
+                methods=["POST"],
+            ),
+            Mount("/", app=WSGIMiddleware(flask_app, workers=ASGI_WSGI_THREADS)),
+        ],
+        middleware=[
+            Middleware(
+                CORSMiddleware,
+                allow_origins=["*"],
+                allow_methods=["*"],
+                allow_headers=["*"],
+            )
+        ],
+        lifespan=lifespan,
+    )
+
+
+app = create_asgi_app()
+
+if __name__ == "__main__":
+    import uvicorn
+
+    port = int(os.environ.get("PORT", 8080))
+    uvicorn.run(app, host="0.0.0.0", port=port)
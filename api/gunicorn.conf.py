@@ -0,0 +1,6 @@
+from utils.llm_clients import close_clients
+
+
+def worker_exit(server, worker):
+    # Each worker opens its own model client pools after fork; close them on exit
+    close_clients()
@@ -16,9 +16,71 @@ import io
 import time
 from openai import APIError
 import uuid
+from functools import lru_cache
+from utils.preview_engine import (
+    SINGLE_IMAGE_MAX_FRAMES,
+    SpeculativePreview,
+    get_preview,
+)
+from utils.cancellation import Deadline, DeadlineExceeded, closing_stream
+from utils.llm_clients import get_client
+from utils.history_compaction import compact_history
+from utils.chat_sessions import SessionStore, saving_session
+from utils.response_cache import (
+    LLM_RESPONSE_CACHE_ENABLED,
+    ResponseCache,
+    response_cache_key,
+)
+from utils.docs_index import manim_docs_for
+from utils.prompt_cache import (
+    PROMPT_PREFIX_CACHE_SIZE,
+    cached_messages,
+    cached_system,
+    create_message,
+    prompt_cache_stats,
+)
+from utils.chat_tools import (
+    AnthropicReply,
+    anthropic_error_frame,
+    anthropic_preview_frames,
+    anthropic_tool_result,
+    final_frame,
+    function_call_frame,
+    function_call_message,
+    function_result_frame,
+    function_result_messages,
+)
+from utils.stream_encoder import (
+    StreamEncoder,
+    json_args_frame,
+    json_text_frame,
+    raw_frame,
+    vercel_text_frame,
+)
 
 chat_generation_bp = Blueprint("chat_generation", __name__)
 
+ANTHROPIC_MODEL = "claude-3-5-sonnet-20241022"
+OPENAI_MODEL = "gpt-4o"
+
+chat_sessions = SessionStore(
+    os.getenv(
+        "CHAT_SESSIONS_DB",
+        os.path.join(
+            os.path.dirname(os.path.dirname(__file__)), "instance", "chat_sessions.db"
+        ),
+    )
+)
+
+response_cache = ResponseCache(
+    os.getenv(
+        "LLM_RESPONSE_CACHE_DIR",
+        os.path.join(
+            os.path.dirname(os.path.dirname(__file__)), "instance", "response_cache"
+        ),
+    )
+)
+
 
 animo_functions = {
     "openai": [
@@ -68,36 +130,7 @@ animo_functions = {
 }
 
 
-@chat_generation_bp.route("/v1/chat/generation", methods=["POST"])
-def generate_code_chat():
-    """
-    This endpoint generates code for animations using OpenAI or Anthropic.
-    It supports both OpenAI and Anthropic models and returns a stream of content.
-
-    When calling this endpoint, enable `is_for_platform` to interact with the platform 'Animo'.
-    """
-    print("Received request for /v1/chat/generation")
-
-    data = request.json
-    print(f"Request data: {json.dumps(data, indent=2)}")
-
-    messages = data.get("messages", [])
-    prompt = data.get("prompt")
-    global_prompt = data.get("globalPrompt", "")
-    user_id = data.get("userId") or f"user-{uuid.uuid4()}"
-    scenes = data.get("scenes", [])
-    project_title = data.get("projectTitle", "")
-    engine = data.get("engine", "openai")
-    selected_scenes = data.get("selectedScenes", [])
-    is_for_platform = data.get("isForPlatform", False)
-
-    if not messages and prompt:
-        messages = [{"role": "user", "content": prompt}]
-
-    print("messages")
-    print(messages)
-
-    general_system_prompt = """You are an assistant that creates animations with Manim. Manim is a mathematical animation engine that is used to create videos programmatically. You are running on Animo (www.animo.video), a tool to create videos with Manim.
+GENERAL_SYSTEM_PROMPT = """You are an assistant that creates animations with Manim. Manim is a mathematical animation engine that is used to create videos programmatically. You are running on Animo (www.animo.video), a tool to create videos with Manim.
 
 # What the user can do?
 
@@ -203,154 +236,144 @@ That message should appear after the code, as the last message of the conversati
 {manimDocs}
 """
 
-    messages.insert(0, {"role": "system", "content": general_system_prompt})
 
-    if engine == "anthropic":
-        client = anthropic.Anthropic(api_key=os.environ.get("ANTHROPIC_API_KEY"))
+def format_scenes(scenes: list) -> str:
+    lines = []
+    for scene in scenes:
+        if isinstance(scene, dict):
+            scene = scene.get("title") or scene.get("name") or json.dumps(scene)
+        lines.append(f"- {scene}")
+    return "\n".join(lines) or "(no scenes yet)"
 
-        def get_preview(code: str, class_name: str):
-            """
-            get_preview is a function that generates PNGs frames from a Manim script animation.
 
-            IMPORTANT: This version of the function will only work for OpenAI models.
-            """
-
-            print("Generating preview")
+@lru_cache(maxsize=PROMPT_PREFIX_CACHE_SIZE)
+def render_prompt_prefix(project_title: str, scenes_prompt: str) -> str:
+    """
+    The system prompt up to the Manim reference. It only depends on the project,
+    so it is rendered once and stays byte-identical across turns, which is what
+    the providers' prompt caching needs.
+    """
+    template = GENERAL_SYSTEM_PROMPT.split("{manimDocs}")[0]
+    return template.replace("{project_title}", project_title).replace(
+        "{scenes_prompt}", scenes_prompt
+    )
 
-            # Get the absolute path of the current script (in api/routes)
-            current_dir = os.path.dirname(os.path.abspath(__file__))
-            api_dir = os.path.dirname(current_dir)  # This should be the /api directory
 
-            # Create the temporary directory inside /api
-            temp_dir = os.path.join(api_dir, "temp_manim")
-            os.makedirs(temp_dir, exist_ok=True)
+def prompt_prefix(data: dict) -> str:
+    return render_prompt_prefix(
+        data.get("projectTitle", ""), format_scenes(data.get("scenes", []))
+    )
 
-            # Create the Python file in the temporary location
-            file_name = f"{class_name}.py"
-            file_path = os.path.join(temp_dir, file_name)
 
-            preview_code = f"""
-from manim import *
-from math import *
+def build_chat_messages(data: dict) -> list:
+    """
+    Returns the conversation for the model: the system prompt, with the Manim
+    reference entries relevant to the conversation, then the request's messages,
+    or a single user message with its `prompt`.
 
-{code}
-            """
+    With a `sessionId`, the request only carries the new messages and they are
+    appended to the history stored for that session.
+    """
+    messages = data.get("messages", [])
+    prompt = data.get("prompt")
+    if not messages and prompt:
+        messages = [{"role": "user", "content": prompt}]
+    if data.get("sessionId"):
+        messages = chat_sessions.get(data["sessionId"]) + messages
+    system_prompt = prompt_prefix(data) + manim_docs_for(docs_query(messages)) + "\n"
+    messages.insert(0, {"role": "system", "content": system_prompt})
+    return messages
 
-            with open(file_path, "w") as f:
-                f.write(preview_code)
 
-            # Run the Manim command
-            command = f"manim {file_path} {class_name} --format=png --media_dir {temp_dir} --custom_folders -pql --disable_caching"
+def docs_query(messages: list, num_messages: int = 4) -> str:
+    """
+    Returns the text of the latest messages (the user's request and the code being
+    worked on, from OpenAI function calls or Anthropic `tool_use` blocks), used to
+    pick the relevant Manim reference entries.
+    """
+    texts = []
+    for message in messages[-num_messages:]:
+        content = message.get("content")
+        if isinstance(content, str):
+            texts.append(content)
+        elif isinstance(content, list):
+            for part in content:
+                if not isinstance(part, dict):
+                    continue
+                if part.get("type") == "tool_use":
+                    texts.append(str((part.get("input") or {}).get("code", "")))
+                else:
+                    texts.append(part.get("text", ""))
+        if function_call := message.get("function_call"):
+            arguments = function_call.get("arguments", "")
             try:
-                result = subprocess.run(
-                    command, shell=True, check=True, capture_output=True, text=True
-                )
-
-                print(f"Result: {result}")
+                texts.append(str(json.loads(arguments).get("code", "")))
+            except (ValueError, AttributeError):
+                texts.append(arguments)
+    return "\n".join(texts)
+
+
+def convert_message_for_anthropic(message):
+    if isinstance(message["content"], list):
+        content = []
+        for part in message["content"]:
+            if part.get("type") == "image_url":
+                content.append({"type": "image", "image": part["image_url"]["url"]})
+            else:
+                content.append(part)
+        message["content"] = content
+    return message
 
-                # Create the previews directory if it doesn't exist
-                previews_dir = os.path.join(api_dir, "public", "previews")
-                os.makedirs(previews_dir, exist_ok=True)
 
-                # Generate a random string for the subfolder
-                random_string = "".join(
-                    random.choices(string.ascii_letters + string.digits, k=12)
-                )
+@chat_generation_bp.route("/v1/chat/generation", methods=["POST"])
+def generate_code_chat():
+    """
+    This endpoint generates code for animations using OpenAI or Anthropic.
+    It supports both OpenAI and Anthropic models and returns a stream of content.
 
-                # Move the generated PNGs to the previews directory
-                source_dir = temp_dir
-                destination_dir = os.path.join(previews_dir, random_string, class_name)
+    When calling this endpoint, enable `is_for_platform` to interact with the platform 'Animo'.
+    """
+    print("Received request for /v1/chat/generation")
 
-                # Find all PNG files in the source directory
-                png_files = [f for f in os.listdir(source_dir) if f.endswith(".png")]
+    data = request.json
+    # The body can hold base64 frames, so only its outline is logged
+    print(
+        f"Request data: {len(data.get('messages', []))} messages, "
+        f"engine={data.get('engine', 'openai')}, session={data.get('sessionId')}"
+    )
 
-                if png_files:
-                    os.makedirs(destination_dir, exist_ok=True)
-                    image_list = []
-                    for png_file in png_files:
-                        shutil.move(
-                            os.path.join(source_dir, png_file),
-                            os.path.join(destination_dir, png_file),
-                        )
-                        # Extract the index from the filename
-                        match = re.search(r"(\d+)\.png$", png_file)
-                        if match:
-                            index = int(match.group(1))
-                            if (
-                                index % 4 == 0
-                            ):  # Only include frames where index is divisible by 5
-                                image_path = os.path.join(destination_dir, png_file)
-                                with Image.open(image_path) as img:
-                                    # Calculate new dimensions (half the original size)
-                                    width, height = img.size
-                                    new_width = width // 4
-                                    new_height = height // 4
-                                    # Resize the image
-                                    resized_img = img.resize(
-                                        (new_width, new_height), Image.LANCZOS
-                                    )
-                                    # Save the resized image to a bytes buffer
-                                    buffer = io.BytesIO()
-                                    resized_img.save(buffer, format="PNG")
-                                    # Get the base64 encoding of the resized image
-                                    base64_image = base64.b64encode(
-                                        buffer.getvalue()
-                                    ).decode("utf-8")
-                                image_list.append(
-                                    {
-                                        "path": image_path,
-                                        "index": index,
-                                        "base64": base64_image,
-                                    }
-                                )
-                    image_list.sort(key=lambda x: x["index"])
-                    return json.dumps(
-                        {
-                            "message": f"Animation preview generated. Now you will see the image frames in the next automatic message...",
-                            "images": image_list,
-                        }
-                    )
-                else:
-                    print(f"No PNG files found in: {source_dir}")
-                    return json.dumps(
-                        {
-                            "error": f"No preview files generated at expected location: {source_dir}",
-                            "images": [],
-                        }
-                    )
-            except subprocess.CalledProcessError as e:
-                error_output = e.stdout + e.stderr
-                print(f"Error running Manim command: {str(e)}")
-                print(f"Command output:\n{error_output}")
-                return json.dumps(
-                    {
-                        "error": f"ERROR. Error generating preview, please think on what could be the problem, and use `get_preview` to run the code again: {str(e)}\nCommand output:\n{error_output}",
-                        "images": [],
-                    }
-                )
-            except Exception as e:
-                print(f"Unexpected error: {str(e)}")
-                return json.dumps(
-                    {"error": f"Unexpected error: {str(e)}", "images": []}
-                )
+    messages = build_chat_messages(data)
+    global_prompt = data.get("globalPrompt", "")
+    user_id = data.get("userId") or f"user-{uuid.uuid4()}"
+    scenes = data.get("scenes", [])
+    project_title = data.get("projectTitle", "")
+    engine = data.get("engine", "openai")
+    selected_scenes = data.get("selectedScenes", [])
+    is_for_platform = data.get("isForPlatform", False)
+    # The model stream is closed on client disconnect, or once this passes
+    deadline = Deadline()
+
+    session_id = data.get("sessionId")
+    print(f"Conversation has {len(messages) - 1} messages")
+
+    # Identical requests are answered from the response cache when it is enabled
+    cache_key = None
+    if LLM_RESPONSE_CACHE_ENABLED and data.get("cache", True):
+        cache_key = response_cache_key(
+            engine,
+            ANTHROPIC_MODEL if engine == "anthropic" else OPENAI_MODEL,
+            is_for_platform,
+            messages,
+        )
 
-        def convert_message_for_anthropic(message):
-            if isinstance(message["content"], list):
-                content = []
-                for part in message["content"]:
-                    if part.get("type") == "image_url":
-                        content.append(
-                            {"type": "image", "image": part["image_url"]["url"]}
-                        )
-                    else:
-                        content.append(part)
-                message["content"] = content
-            return message
+    if engine == "anthropic":
+        client = get_client("anthropic")
 
         # Extract system message and remove it from the messages list
         system_message = next(
             (msg["content"] for msg in messages if msg["role"] == "system"), None
         )
+        prefix = prompt_prefix(data)
         anthropic_messages = [
             convert_message_for_anthropic(msg)
             for msg in messages
@@ -358,6 +381,10 @@ from math import *
         ]
 
         def generate():
+            # Coalesces text deltas into fewer frames of the data stream
+            encoder = StreamEncoder(
+                {"text": vercel_text_frame if is_for_platform else raw_frame}
+            )
             try:
                 messages = anthropic_messages
                 while True:
@@ -383,180 +410,81 @@ from math import *
                             print(f"Content: {msg['content']}")
                     print("\n=== End of message history ===")
 
-                    stream = client.messages.create(
-                        model="claude-3-5-sonnet-20241022",
-                        messages=messages,
-                        system=system_message,
+                    stream = create_message(
+                        client,
+                        model=ANTHROPIC_MODEL,
+                        messages=cached_messages(compact_history(messages)),
+                        system=cached_system(system_message, prefix),
                         max_tokens=1000,
                         stream=True,
                         tools=animo_functions["anthropic"],
                     )
 
-                    current_message = {"role": "assistant", "content": []}
-                    current_text = ""  # To accumulate text content
-                    json_buffer = ""
+                    reply = AnthropicReply(encoder)
                     should_continue = False
-                    tool_use_id = None
-                    complete_json = ""
 
-                    for chunk in stream:
+                    for chunk in closing_stream(stream, deadline):
                         print(f"\nChunk type: {chunk.type}")
                         print(f"Chunk content: {chunk}")
 
-                        if chunk.type == "content_block_start":
-                            if hasattr(chunk.content_block, "type"):
-                                if chunk.content_block.type == "tool_use":
-                                    tool_use_id = chunk.content_block.id
-                                    print(f"Captured tool_use_id: {tool_use_id}")
+                        if chunk.type == "message_start":
+                            prompt_cache_stats.record(chunk.message.usage)
 
-                                    # If we have accumulated text, add it first
-                                    if current_text:
-                                        current_message["content"].append(
-                                            {"type": "text", "text": current_text}
-                                        )
-                                        current_text = ""
-
-                                    # Add tool use block
-                                    tool_input = {}
-                                    if complete_json:
-                                        try:
-                                            tool_input = json.loads(complete_json)
-                                        except json.JSONDecodeError:
-                                            print("Failed to parse tool input JSON")
-
-                                    current_message["content"].append(
-                                        {
-                                            "type": "tool_use",
-                                            "id": tool_use_id,
-                                            "name": "get_preview",
-                                            "input": tool_input,
-                                        }
-                                    )
+                        elif chunk.type == "content_block_start":
+                            if getattr(chunk.content_block, "type", None) == "tool_use":
+                                print(f"Captured tool_use_id: {chunk.content_block.id}")
+                                # Send the buffered text before the tool call runs
+                                if frame := reply.start_tool_use(
+                                    chunk.content_block.id
+                                ):
+                                    yield frame
 
                         elif chunk.type == "content_block_delta":
                             if hasattr(chunk.delta, "text"):
-                                content = chunk.delta.text
-                                if content:
-                                    print(f"Text content: {content}")
-                                    current_text += content  # Accumulate text
-                                    if is_for_platform:
-                                        for char in content:
-                                            escaped_char = repr(char)[1:-1]
-                                            yield f'0:"{escaped_char}"\n'
-                                    else:
-                                        yield content
+                                if chunk.delta.text:
+                                    if frame := reply.write(chunk.delta.text):
+                                        yield frame
 
                             elif hasattr(chunk.delta, "partial_json"):
-                                complete_json += chunk.delta.partial_json
-                                print(f"Accumulated complete JSON: {complete_json}")
+                                reply.feed_json(chunk.delta.partial_json)
 
                         elif chunk.type == "content_block_stop":
-                            if complete_json:
-                                try:
-                                    print("\n=== Processing tool call ===")
-                                    tool_call = json.loads(complete_json)
-                                    print(
-                                        f"Tool call data: {json.dumps(tool_call, indent=2)}"
-                                    )
-                                    print(f"Using tool_use_id: {tool_use_id}")
-
-                                    preview_result = get_preview(
-                                        code=tool_call.get("code", ""),
-                                        class_name=tool_call.get("class_name", ""),
-                                    )
-
-                                    try:
-                                        preview_data = json.loads(preview_result)
-                                        print(
-                                            "\nParsed preview data keys:",
-                                            preview_data.keys(),
-                                        )
+                            try:
+                                tool_call = reply.finish_tool_use()
+                                if tool_call is None:
+                                    continue
+                                print("\n=== Processing tool call ===")
+                                print(
+                                    f"Tool call data: {json.dumps(tool_call, indent=2)}"
+                                )
 
-                                        # Just use the middle frame for testing
-                                        middle_frame = preview_data["images"][
-                                            len(preview_data["images"]) // 2
-                                        ]
-                                        base64_data = middle_frame["base64"]
+                                # Only one image is sent, so only one is rendered
+                                preview_result = get_preview(
+                                    code=tool_call.get("code", ""),
+                                    class_name=tool_call.get("class_name", ""),
+                                    max_frames=SINGLE_IMAGE_MAX_FRAMES,
+                                )
+                                tool_response = anthropic_tool_result(
+                                    reply.tool_use_id, preview_result
+                                )
 
-                                        # Debug the base64 data
-                                        print(
-                                            f"\nBase64 data length: {len(base64_data)}"
-                                        )
-                                        print(
-                                            f"Base64 data starts with: {base64_data[:50]}"
-                                        )
-                                        print(
-                                            f"Base64 data ends with: {base64_data[-50:]}"
-                                        )
-
-                                        # Create simplified content blocks with just one frame
-                                        content_blocks = [
-                                            {
-                                                "type": "image",
-                                                "source": {
-                                                    "type": "base64",
-                                                    "media_type": "image/png",
-                                                    "data": base64_data,  # Use raw base64 without prefix
-                                                },
-                                            },
-                                            {
-                                                "type": "text",
-                                                "text": f"\nPreview frame from the animation.\n",
-                                            },
-                                        ]
-
-                                        tool_response = {
-                                            "role": "user",
-                                            "content": [
-                                                {
-                                                    "type": "tool_result",
-                                                    "tool_use_id": tool_use_id,
-                                                    "content": content_blocks,
-                                                }
-                                            ],
-                                        }
-
-                                        print(f"\nTool response structure:")
-                                        print(json.dumps(tool_response, indent=2))
-
-                                        # Add the assistant's message with tool use before adding tool result
-                                        messages.append(current_message)
-                                        messages.append(tool_response)
-                                        should_continue = True
-
-                                        preview_text = (
-                                            "Generated preview of the animation:\n"
-                                        )
-                                        if is_for_platform:
-                                            for char in preview_text:
-                                                escaped_char = repr(char)[1:-1]
-                                                yield f'0:"{escaped_char}"\n'
-                                            yield f'0:"[IMAGE: Preview frame]"\n'
-                                        else:
-                                            yield "\n[Preview frame]\n"
-
-                                    except json.JSONDecodeError:
-                                        print("Failed to parse preview result as JSON")
-                                        print("Raw preview result:", preview_result)
-                                        continue
-
-                                except Exception as e:
-                                    print(f"Error processing tool call: {str(e)}")
-                                    continue
+                                # Add the assistant's message with tool use before adding tool result
+                                messages.append(reply.message)
+                                messages.append(tool_response)
+                                should_continue = True
+                                yield anthropic_preview_frames(encoder, is_for_platform)
+                            except Exception as e:
+                                print(f"Error processing tool call: {str(e)}")
+                                continue
 
                         elif chunk.type == "message_stop":
                             print("\n=== Message stream ended ===")
+                            frame, has_text = reply.finish()
+                            if frame:
+                                yield frame
                             # Add any remaining text content
-                            if current_text:
-                                if not current_message["content"]:
-                                    current_message["content"] = []
-                                current_message["content"].append(
-                                    {"type": "text", "text": current_text}
-                                )
-                                messages.append(current_message)
-
-                            if not should_continue:
-                                return
+                            if has_text:
+                                messages.append(reply.message)
                             break
 
                     if not should_continue:
@@ -564,13 +492,19 @@ from math import *
 
             except Exception as e:
                 print(f"\n=== Error occurred ===\nError details: {str(e)}")
-                error_message = (
-                    f'0:"{str(e)}"\n' if is_for_platform else f"Error: {str(e)}"
-                )
-                yield error_message
+                yield encoder.flush() + anthropic_error_frame(e, is_for_platform)
 
         response = Response(
-            stream_with_context(generate()),
+            stream_with_context(
+                saving_session(
+                    response_cache.stream(cache_key, anthropic_messages, generate)
+                    if cache_key
+                    else generate(),
+                    chat_sessions,
+                    session_id,
+                    anthropic_messages,
+                )
+            ),
             content_type="text/plain; charset=utf-8"
             if is_for_platform
             else "text/event-stream",
@@ -578,138 +512,21 @@ from math import *
         if is_for_platform:
             response.headers["Transfer-Encoding"] = "chunked"
             response.headers["x-vercel-ai-data-stream"] = "v1"
+        if session_id:
+            response.headers["x-session-id"] = session_id
         return response
 
     else:
-        client = openai.OpenAI(api_key=os.environ.get("OPENAI_API_KEY"))
-
-        def get_preview(code: str, class_name: str):
-            """
-            get_preview is a function that generates PNGs frames from a Manim script animation.
-
-            IMPORTANT: This version of the function will only work for OpenAI models.
-            """
-
-            print("Generating preview")
-
-            # Get the absolute path of the current script (in api/routes)
-            current_dir = os.path.dirname(os.path.abspath(__file__))
-            api_dir = os.path.dirname(current_dir)  # This should be the /api directory
-
-            # Create the temporary directory inside /api
-            temp_dir = os.path.join(api_dir, "temp_manim")
-            os.makedirs(temp_dir, exist_ok=True)
-
-            # Create the Python file in the temporary location
-            file_name = f"{class_name}.py"
-            file_path = os.path.join(temp_dir, file_name)
-
-            preview_code = f"""
-from manim import *
-from math import *
-
-{code}
-            """
-
-            with open(file_path, "w") as f:
-                f.write(preview_code)
-
-            # Run the Manim command
-            command = f"manim {file_path} {class_name} --format=png --media_dir {temp_dir} --custom_folders -pql --disable_caching"
-            try:
-                result = subprocess.run(
-                    command, shell=True, check=True, capture_output=True, text=True
-                )
-
-                print(f"Result: {result}")
-
-                # Create the previews directory if it doesn't exist
-                previews_dir = os.path.join(api_dir, "public", "previews")
-                os.makedirs(previews_dir, exist_ok=True)
-
-                # Generate a random string for the subfolder
-                random_string = "".join(
-                    random.choices(string.ascii_letters + string.digits, k=12)
-                )
-
-                # Move the generated PNGs to the previews directory
-                source_dir = temp_dir
-                destination_dir = os.path.join(previews_dir, random_string, class_name)
-
-                # Find all PNG files in the source directory
-                png_files = [f for f in os.listdir(source_dir) if f.endswith(".png")]
-
-                if png_files:
-                    os.makedirs(destination_dir, exist_ok=True)
-                    image_list = []
-                    for png_file in png_files:
-                        shutil.move(
-                            os.path.join(source_dir, png_file),
-                            os.path.join(destination_dir, png_file),
-                        )
-                        # Extract the index from the filename
-                        match = re.search(r"(\d+)\.png$", png_file)
-                        if match:
-                            index = int(match.group(1))
-                            if (
-                                index % 4 == 0
-                            ):  # Only include frames where index is divisible by 5
-                                image_path = os.path.join(destination_dir, png_file)
-                                with Image.open(image_path) as img:
-                                    # Calculate new dimensions (half the original size)
-                                    width, height = img.size
-                                    new_width = width // 4
-                                    new_height = height // 4
-                                    # Resize the image
-                                    resized_img = img.resize(
-                                        (new_width, new_height), Image.LANCZOS
-                                    )
-                                    # Save the resized image to a bytes buffer
-                                    buffer = io.BytesIO()
-                                    resized_img.save(buffer, format="PNG")
-                                    # Get the base64 encoding of the resized image
-                                    base64_image = base64.b64encode(
-                                        buffer.getvalue()
-                                    ).decode("utf-8")
-                                image_list.append(
-                                    {
-                                        "path": image_path,
-                                        "index": index,
-                                        "base64": base64_image,
-                                    }
-                                )
-                    image_list.sort(key=lambda x: x["index"])
-                    return json.dumps(
-                        {
-                            "message": f"Animation preview generated. Now you will see the image frames in the next automatic message...",
-                            "images": image_list,
-                        }
-                    )
-                else:
-                    print(f"No PNG files found in: {source_dir}")
-                    return json.dumps(
-                        {
-                            "error": f"No preview files generated at expected location: {source_dir}",
-                            "images": [],
-                        }
-                    )
-            except subprocess.CalledProcessError as e:
-                error_output = e.stdout + e.stderr
-                print(f"Error running Manim command: {str(e)}")
-                print(f"Command output:\n{error_output}")
-                return json.dumps(
-                    {
-                        "error": f"ERROR. Error generating preview, please think on what could be the problem, and use `get_preview` to run the code again: {str(e)}\nCommand output:\n{error_output}",
-                        "images": [],
-                    }
-                )
-            except Exception as e:
-                print(f"Unexpected error: {str(e)}")
-                return json.dumps(
-                    {"error": f"Unexpected error: {str(e)}", "images": []}
-                )
+        client = get_client("openai")
 
         def generate():
+            # Coalesces text and function argument deltas into fewer frames
+            encoder = StreamEncoder(
+                {
+                    "text": json_text_frame if is_for_platform else raw_frame,
+                    "args": json_args_frame,
+                }
+            )
             max_retries = 3
             retry_delay = 4  # seconds
 
@@ -717,58 +534,53 @@ from math import *
                 for attempt in range(max_retries):
                     try:
                         stream = client.chat.completions.create(
-                            model="gpt-4o",
-                            messages=messages,
+                            model=OPENAI_MODEL,
+                            messages=compact_history(messages),
                             stream=True,
                             functions=animo_functions["openai"],
                             function_call="auto",
                         )
                         function_call_data = ""
                         function_name = ""
-                        for chunk in stream:
+                        reply_text = ""
+                        speculative_preview = SpeculativePreview()
+                        for chunk in closing_stream(stream, deadline):
                             if chunk.choices[0].delta.content:
                                 content = chunk.choices[0].delta.content
-                                if is_for_platform:
-                                    text_obj = json.dumps(
-                                        {"type": "text", "text": content}
-                                    )
-                                    yield f"{text_obj}\n"
-                                else:
-                                    yield content
+                                reply_text += content
+                                if frame := encoder.write(content):
+                                    yield frame
                             elif chunk.choices[0].delta.function_call:
                                 if chunk.choices[0].delta.function_call.name:
                                     function_name = chunk.choices[
                                         0
                                     ].delta.function_call.name
                                     if is_for_platform:
-                                        initial_call_obj = json.dumps(
-                                            {
-                                                "type": "function_call",
-                                                "content": "",
-                                                "function_call": {
-                                                    "name": function_name
-                                                },
-                                            }
+                                        yield encoder.flush() + function_call_frame(
+                                            function_name
                                         )
-                                        yield f"{initial_call_obj}\n"
                                 if chunk.choices[0].delta.function_call.arguments:
                                     chunk_data = chunk.choices[
                                         0
                                     ].delta.function_call.arguments
                                     function_call_data += chunk_data
-                                    if is_for_platform:
-                                        partial_call_obj = json.dumps(
-                                            {
-                                                "type": "function_call",
-                                                "content": "",
-                                                "function_call": {"args": chunk_data},
-                                            }
-                                        )
-                                        yield f"{partial_call_obj}\n"
-
+                                    if function_name == "get_preview":
+                                        speculative_preview.feed(chunk_data)
+                                    if is_for_platform and (
+                                        frame := encoder.write(chunk_data, "args")
+                                    ):
+                                        yield frame
+
+                        if frame := encoder.flush():
+                            yield frame
                         # If we get here, the stream completed successfully
                         break
 
+                    except DeadlineExceeded as e:
+                        print(f"Cancelling chat: {str(e)}")
+                        yield encoder.flush() + json.dumps({"error": str(e)})
+                        return
+
                     except APIError as e:
                         if attempt < max_retries - 1:
                             print(
@@ -777,127 +589,74 @@ from math import *
                             time.sleep(retry_delay)
                         else:
                             print(f"Max retries reached. APIError: {str(e)}")
-                            yield json.dumps(
+                            yield encoder.flush() + json.dumps(
                                 {"error": "Max retries reached due to API errors"}
                             )
                             return  # Exit the generator
 
-                if function_call_data:
-                    # Add the function call to messages
-                    messages.append(
-                        {
-                            "role": "assistant",
-                            "content": None,
-                            "function_call": {
-                                "name": function_name,
-                                "arguments": function_call_data,
-                            },
-                        }
-                    )
-
-                    # Yield the whole object back to the frontend
-                    function_call_obj = json.dumps(
-                        {
-                            "role": "assistant",
-                            "content": None,
-                            "function_call": {
-                                "name": function_name,
-                                "arguments": function_call_data,
-                            },
-                        }
-                    )
-                    if is_for_platform:
-                        pass
-                        # text_obj = json.dumps({"type": "text", "text": function_call_obj})
-                        # yield f'{text_obj}\n'
-                    else:
-                        pass
-
-                    # Actually call get_preview
-                    if function_name == "get_preview":
-                        print(f"Calling get_preview with data: {function_call_data}")
-                        args = json.loads(function_call_data)
-                        result = get_preview(args["code"], args["class_name"])
-                        result_json = json.loads(result)
-                        function_response = {
-                            "content": result_json.get(
-                                "message", result_json.get("error")
-                            ),
-                            "name": "get_preview",
-                            "role": "function",
-                        }
-                        messages.append(function_response)
-
-                        # Yield the function response back to the frontend
-                        if is_for_platform:
-                            function_result_obj = json.dumps(
-                                {
-                                    "type": "function_result",
-                                    "content": function_response,
-                                    "function_call": {"name": function_name},
-                                }
-                            )
-                            yield f"{function_result_obj}\n"
-                        else:
-                            pass
-                            # yield json.dumps(function_response)
-
-                        # Only create and send image_message if there are images
-                        if result_json.get("images"):
-                            # Create a new message with the images
-                            image_message = {
-                                "role": "user",
-                                "content": [
-                                    {
-                                        "type": "text",
-                                        "text": """ASSISTANT_MESSAGE_PREVIEW_GENERATED: This message is not generated by the user, but automatically by you, the assistant when firing the `get_preview` function, this message might not be visible to the user.
-
-                                        The following images are the frames of the animation generated. Please check all the frames and follow the rules: Text should not be overlapping, the space should be used efficiently, use different colors to represent different objects, plus other improvements you can think of.
-
-                                        You can decide now if you want to iterate on the animation (if it's too complex), or just stop here and provide the final code to the user now.""",
-                                    }
-                                ],
-                            }
-                            for image in result_json["images"]:
-                                image_message["content"].append(
-                                    {
-                                        "type": "image_url",
-                                        "image_url": {
-                                            "url": f"data:image/png;base64,{image['base64']}"
-                                        },
-                                    }
-                                )
-                            messages.append(image_message)
-
-                            # Yield the image message back to the frontend
-                            image_message_obj = json.dumps(image_message)
-                            if is_for_platform:
-                                pass
-                                # text_obj = json.dumps({"type": "text", "text": image_message_obj})
-                                # yield f'{text_obj}\n'
-                            else:
-                                yield image_message_obj
-
-                        # Trigger a new response from the assistant
-                        continue  # This will start a new iteration of the while loop
-                    else:
-                        break  # Exit the loop if it's not a get_preview function call
-                else:
+                if not function_call_data:
+                    # Keep the reply in the history (it is saved with a session)
+                    if reply_text:
+                        messages.append({"role": "assistant", "content": reply_text})
                     break  # Exit the loop if there's no function call
+                if function_name != "get_preview":
+                    break
+
+                messages.append(
+                    function_call_message(reply_text, function_name, function_call_data)
+                )
+
+                # Actually call get_preview
+                print(f"Calling get_preview with data: {function_call_data}")
+                args = json.loads(function_call_data)
+                function_response, image_message = function_result_messages(
+                    get_preview(args["code"], args["class_name"])
+                )
+                messages.append(function_response)
+
+                # Yield the function response back to the frontend
+                if is_for_platform:
+                    yield function_result_frame(function_response, function_name)
+
+                # Only send an image message if there are images
+                if image_message:
+                    messages.append(image_message)
+                    if not is_for_platform:
+                        yield json.dumps(image_message)
 
             # Final message when there are no more function calls
-            final_message = "\n"
-            if is_for_platform:
-                text_obj = json.dumps({"type": "text", "text": final_message})
-                yield f"{text_obj}\n"
-            else:
-                yield final_message
+            yield final_frame(is_for_platform)
 
         print("Generating response")
         response = Response(
-            stream_with_context(generate()), content_type="text/plain; charset=utf-8"
+            stream_with_context(
+                saving_session(
+                    response_cache.stream(cache_key, messages, generate)
+                    if cache_key
+                    else generate(),
+                    chat_sessions,
+                    session_id,
+                    messages,
+                )
+            ),
+            content_type="text/plain; charset=utf-8",
         )
         if is_for_platform:
             response.headers["Transfer-Encoding"] = "chunked"
             response.headers["x-vercel-ai-data-stream"] = "v1"
+        if session_id:
+            response.headers["x-session-id"] = session_id
         return response
+
+
+@chat_generation_bp.route("/v1/chat/generation/cache", methods=["GET"])
+def get_chat_cache_stats():
+    return (
+        jsonify(
+            {
+                "prompt_cache": prompt_cache_stats.stats(),
+                "response_cache": response_cache.stats(),
+            }
+        ),
+        200,
+    )
@@ -0,0 +1,323 @@
+import asyncio
+import json
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from openai import APIError
+from starlette.requests import Request
+from starlette.responses import StreamingResponse
+from routes.chat_generation import (
+    ANTHROPIC_MODEL,
+    OPENAI_MODEL,
+    animo_functions,
+    build_chat_messages,
+    chat_sessions,
+    convert_message_for_anthropic,
+    prompt_prefix,
+    response_cache,
+)
+from utils.admission import MANIM_MAX_BACKLOG, MANIM_MAX_CONCURRENCY
+from utils.chat_sessions import asaving_session
+from utils.response_cache import LLM_RESPONSE_CACHE_ENABLED, response_cache_key
+from utils.keyframes import PREVIEW_MAX_FRAMES
+from utils.preview_engine import (
+    SINGLE_IMAGE_MAX_FRAMES,
+    SpeculativePreview,
+    get_preview,
+)
+from utils.cancellation import Deadline, DeadlineExceeded, aclosing_stream
+from utils.llm_clients import get_client
+from utils.history_compaction import compact_history
+from utils.prompt_cache import (
+    cached_messages,
+    cached_system,
+    create_message,
+    prompt_cache_stats,
+)
+from utils.chat_tools import (
+    AnthropicReply,
+    anthropic_error_frame,
+    anthropic_preview_frames,
+    anthropic_tool_result,
+    final_frame,
+    function_call_frame,
+    function_call_message,
+    function_result_frame,
+    function_result_messages,
+)
+from utils.stream_encoder import (
+    StreamEncoder,
+    json_args_frame,
+    json_text_frame,
+    raw_frame,
+    vercel_text_frame,
+)
+
+
+_preview_threads = None
+_preview_threads_lock = threading.Lock()
+
+
+def _preview_executor() -> ThreadPoolExecutor:
+    global _preview_threads
+    with _preview_threads_lock:
+        if _preview_threads is None:
+            _preview_threads = ThreadPoolExecutor(
+                max_workers=max(1, MANIM_MAX_CONCURRENCY + MANIM_MAX_BACKLOG),
+                thread_name_prefix="preview-async",
+            )
+        return _preview_threads
+
+
+async def get_preview_async(
+    code: str, class_name: str, max_frames: int = PREVIEW_MAX_FRAMES
+) -> str:
+    """
+    Runs `get_preview` without blocking the event loop. The preview still runs on
+    a warm manim worker under the admission limits; only the wait happens on a
+    thread of a pool of MANIM_MAX_CONCURRENCY + MANIM_MAX_BACKLOG threads, so
+    previews past that wait for a thread instead of piling up in the loop's
+    default executor.
+    """
+    return await asyncio.get_running_loop().run_in_executor(
+        _preview_executor(), get_preview, code, class_name, max_frames
+    )
+
+
+async def generate_anthropic(
+    messages: list, prefix: str, is_for_platform: bool, deadline: Deadline
+):
+    client = get_client("anthropic", asynchronous=True)
+    encoder = StreamEncoder(
+        {"text": vercel_text_frame if is_for_platform else raw_frame}
+    )
+
+    # Extract system message and remove it from the messages list
+    system_message = next(
+        (msg["content"] for msg in messages if msg["role"] == "system"), None
+    )
+    # Converted in place, so the caller's list gets the turn's replies
+    messages[:] = [
+        convert_message_for_anthropic(msg)
+        for msg in messages
+        if msg["role"] != "system"
+    ]
+
+    try:
+        while True:
+            stream = await create_message(
+                client,
+                model=ANTHROPIC_MODEL,
+                messages=cached_messages(compact_history(messages)),
+                system=cached_system(system_message, prefix),
+                max_tokens=1000,
+                stream=True,
+                tools=animo_functions["anthropic"],
+            )
+
+            reply = AnthropicReply(encoder)
+            should_continue = False
+
+            async for chunk in aclosing_stream(stream, deadline):
+                if chunk.type == "message_start":
+                    prompt_cache_stats.record(chunk.message.usage)
+
+                elif chunk.type == "content_block_start":
+                    if getattr(chunk.content_block, "type", None) == "tool_use":
+                        # Send the buffered text before the tool call runs
+                        if frame := reply.start_tool_use(chunk.content_block.id):
+                            yield frame
+
+                elif chunk.type == "content_block_delta":
+                    if hasattr(chunk.delta, "text"):
+                        if chunk.delta.text:
+                            if frame := reply.write(chunk.delta.text):
+                                yield frame
+
+                    elif hasattr(chunk.delta, "partial_json"):
+                        reply.feed_json(chunk.delta.partial_json)
+
+                elif chunk.type == "content_block_stop":
+                    try:
+                        tool_call = reply.finish_tool_use()
+                        if tool_call is None:
+                            continue
+                        preview_result = await get_preview_async(
+                            code=tool_call.get("code", ""),
+                            class_name=tool_call.get("class_name", ""),
+                            max_frames=SINGLE_IMAGE_MAX_FRAMES,
+                        )
+                        tool_response = anthropic_tool_result(
+                            reply.tool_use_id, preview_result
+                        )
+
+                        # Add the assistant's message with tool use before adding tool result
+                        messages.append(reply.message)
+                        messages.append(tool_response)
+                        should_continue = True
+                        yield anthropic_preview_frames(encoder, is_for_platform)
+                    except Exception as e:
+                        print(f"Error processing tool call: {str(e)}")
+                        continue
+
+                elif chunk.type == "message_stop":
+                    frame, has_text = reply.finish()
+                    if frame:
+                        yield frame
+                    # Add any remaining text content
+                    if has_text:
+                        messages.append(reply.message)
+                    break
+
+            if not should_continue:
+                break
+
+    except Exception as e:
+        print(f"\n=== Error occurred ===\nError details: {str(e)}")
+        yield encoder.flush() + anthropic_error_frame(e, is_for_platform)
+
+
+async def generate_openai(messages: list, is_for_platform: bool, deadline: Deadline):
+    client = get_client("openai", asynchronous=True)
+    encoder = StreamEncoder(
+        {
+            "text": json_text_frame if is_for_platform else raw_frame,
+            "args": json_args_frame,
+        }
+    )
+    max_retries = 3
+    retry_delay = 4  # seconds
+
+    while True:
+        for attempt in range(max_retries):
+            try:
+                function_call_data = ""
+                function_name = ""
+                speculative_preview = SpeculativePreview()
+                reply_text = ""
+                stream = await client.chat.completions.create(
+                    model=OPENAI_MODEL,
+                    messages=compact_history(messages),
+                    stream=True,
+                    functions=animo_functions["openai"],
+                    function_call="auto",
+                )
+                async for chunk in aclosing_stream(stream, deadline):
+                    delta = chunk.choices[0].delta
+                    if delta.content:
+                        reply_text += delta.content
+                        if frame := encoder.write(delta.content):
+                            yield frame
+                    elif delta.function_call:
+                        if delta.function_call.name:
+                            function_name = delta.function_call.name
+                            if is_for_platform:
+                                yield encoder.flush() + function_call_frame(
+                                    function_name
+                                )
+                        if delta.function_call.arguments:
+                            chunk_data = delta.function_call.arguments
+                            function_call_data += chunk_data
+                            if function_name == "get_preview":
+                                speculative_preview.feed(chunk_data)
+                            if is_for_platform and (
+                                frame := encoder.write(chunk_data, "args")
+                            ):
+                                yield frame
+
+                if frame := encoder.flush():
+                    yield frame
+                # If we get here, the stream completed successfully
+                break
+
+            except DeadlineExceeded as e:
+                print(f"Cancelling chat: {str(e)}")
+                yield encoder.flush() + json.dumps({"error": str(e)})
+                return
+
+            except APIError as e:
+                if attempt < max_retries - 1:
+                    print(
+                        f"APIError occurred: {str(e)}. Retrying in {retry_delay} seconds..."
+                    )
+                    await asyncio.sleep(retry_delay)
+                else:
+                    print(f"Max retries reached. APIError: {str(e)}")
+                    yield encoder.flush() + json.dumps(
+                        {"error": "Max retries reached due to API errors"}
+                    )
+                    return
+
+        if not function_call_data:
+            if reply_text:
+                messages.append({"role": "assistant", "content": reply_text})
+            break
+        if function_name != "get_preview":
+            break
+
+        messages.append(
+            function_call_message(reply_text, function_name, function_call_data)
+        )
+
+        args = json.loads(function_call_data)
+        function_response, image_message = function_result_messages(
+            await get_preview_async(args["code"], args["class_name"])
+        )
+        messages.append(function_response)
+
+        if is_for_platform:
+            yield function_result_frame(function_response, function_name)
+
+        # Only send an image message if there are images
+        if image_message:
+            messages.append(image_message)
+            if not is_for_platform:
+                yield json.dumps(image_message)
+
+    # Final message when there are no more function calls
+    yield final_frame(is_for_platform)
+
+
+async def generate_code_chat_async(request: Request):
+    """
+    Async version of `POST /v1/chat/generation`, with the same request body and
+    stream format. Model calls use the async clients, so a stream only costs a
+    coroutine while it waits on the model. When the client disconnects, the
+    response task is cancelled, which also closes the upstream model stream.
+    With a `sessionId`, the history is stored like in the Flask endpoint.
+    SQLite, file and retrieval work runs on threads, off the event loop.
+    """
+    data = await request.json()
+    messages = await asyncio.to_thread(build_chat_messages, data)
+    session_id = data.get("sessionId")
+    engine = data.get("engine", "openai")
+    is_for_platform = data.get("isForPlatform", False)
+    deadline = Deadline()
+
+    if engine == "anthropic":
+        model = ANTHROPIC_MODEL
+        generate = partial(
+            generate_anthropic, messages, prompt_prefix(data), is_for_platform, deadline
+        )
+        media_type = "text/plain" if is_for_platform else "text/event-stream"
+    else:
+        model = OPENAI_MODEL
+        generate = partial(generate_openai, messages, is_for_platform, deadline)
+        media_type = "text/plain"
+
+    if LLM_RESPONSE_CACHE_ENABLED and data.get("cache", True):
+        cache_key = await asyncio.to_thread(
+            response_cache_key, engine, model, is_for_platform, messages
+        )
+        content = response_cache.astream(cache_key, messages, generate)
+    else:
+        content = generate()
+
+    headers = {"x-vercel-ai-data-stream": "v1"} if is_for_platform else {}
+    if session_id:
+        headers["x-session-id"] = session_id
+    return StreamingResponse(
+        asaving_session(content, chat_sessions, session_id, messages),
+        media_type=media_type,
+        headers=headers,
+    )
@@ -0,0 +1,147 @@
+from flask import Blueprint, request, Response, abort
+import hashlib
+import mimetypes
+import os
+import re
+import threading
+from collections import OrderedDict
+from werkzeug.http import http_date, parse_etags
+from werkzeug.security import safe_join
+from werkzeug.wsgi import wrap_file
+from utils.storage import PUBLIC_FOLDER
+
+media_bp = Blueprint("media", __name__)
+
+
+# When set (e.g. "/protected-public"), responses carry an X-Accel-Redirect header
+# so nginx serves the bytes itself and the Python worker is released immediately.
+MEDIA_X_ACCEL_PREFIX = os.getenv("MEDIA_X_ACCEL_PREFIX", "")
+MEDIA_CHUNK_SIZE = 1024 * 1024
+ETAG_CACHE_SIZE = 4096
+
+# Names that can never point to different bytes: names ending in a 64-hex content
+# digest (published videos), and preview frames, which live in a fresh random
+# folder per preview.
+IMMUTABLE_PATTERN = re.compile(r"(^|[/-])[0-9a-f]{64}\.\w+$|^previews/")
+IMMUTABLE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+MUTABLE_CACHE_CONTROL = "public, max-age=0, must-revalidate"
+
+_etags = OrderedDict()
+_etags_lock = threading.Lock()
+
+
+def content_etag(path: str, stat: os.stat_result) -> str:
+    """
+    Returns a strong ETag derived from the file's SHA-256, memoized per
+    (path, mtime, size) so each file is only hashed once.
+    """
+    key = (path, stat.st_mtime_ns, stat.st_size)
+    with _etags_lock:
+        if key in _etags:
+            _etags.move_to_end(key)
+            return _etags[key]
+
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        while chunk := f.read(MEDIA_CHUNK_SIZE):
+            digest.update(chunk)
+    etag = digest.hexdigest()
+
+    with _etags_lock:
+        _etags[key] = etag
+        while len(_etags) > ETAG_CACHE_SIZE:
+            _etags.popitem(last=False)
+    return etag
+
+
+def _read_range(f, length: int):
+    try:
+        while length > 0:
+            chunk = f.read(min(MEDIA_CHUNK_SIZE, length))
+            if not chunk:
+                break
+            length -= len(chunk)
+            yield chunk
+    finally:
+        f.close()
+
+
+def _file_body(f, length: int, size: int):
+    """
+    Returns a WSGI body for `length` bytes starting at the file's current offset.
+
+    gunicorn serves `wsgi.file_wrapper` bodies with os.sendfile() and stops at the
+    Content-Length, so ranges are zero-copy too; other servers only get the
+    wrapper when the rest of the file is wanted.
+    """
+    server = request.environ.get("SERVER_SOFTWARE", "")
+    if length == size - f.tell() or server.startswith("gunicorn"):
+        return wrap_file(request.environ, f, MEDIA_CHUNK_SIZE)
+    return _read_range(f, length)
+
+
+@media_bp.route("/public/<path:filename>", methods=["GET"])
+def serve_media(filename):
+    """
+    Serves rendered videos and previews with byte ranges, strong content-hash
+    ETags and long-lived caching for immutable names.
+    """
+    path = safe_join(PUBLIC_FOLDER, filename)
+    if path is None or not os.path.isfile(path):
+        abort(404)
+
+    stat = os.stat(path)
+    size = stat.st_size
+    etag = content_etag(path, stat)
+
+    headers = {
+        "ETag": f'"{etag}"',
+        "Last-Modified": http_date(stat.st_mtime),
+        "Accept-Ranges": "bytes",
+        "Cache-Control": (
+            IMMUTABLE_CACHE_CONTROL
+            if IMMUTABLE_PATTERN.search(filename)
+            else MUTABLE_CACHE_CONTROL
+        ),
+    }
+    mimetype = mimetypes.guess_type(filename)[0] or "application/octet-stream"
+
+    if_none_match = request.headers.get("If-None-Match")
+    if if_none_match and parse_etags(if_none_match).contains(etag):
+        return Response(status=304, headers=headers)
+
+    start, stop, status = 0, size, 200
+    byte_range = request.range
+    if_range = request.headers.get("If-Range")
+    # Multipart ranges are not supported: those requests get the whole file
+    if (
+        byte_range
+        and len(byte_range.ranges) == 1
+        and (not if_range or if_range.strip('"') == etag)
+    ):
+        requested = byte_range.range_for_length(size)
+        if requested is None:
+            headers["Content-Range"] = f"bytes */{size}"
+            return Response(status=416, headers=headers)
+        start, stop = requested
+        status = 206
+        headers["Content-Range"] = f"bytes {start}-{stop - 1}/{size}"
+
+    length = stop - start
+    headers["Content-Length"] = str(length)
+
+    if MEDIA_X_ACCEL_PREFIX:
+        headers["X-Accel-Redirect"] = f"{MEDIA_X_ACCEL_PREFIX.rstrip('/')}/{filename}"
+        headers.pop("Content-Length")
+        headers.pop("Content-Range", None)
+        return Response(status=200, headers=headers, mimetype=mimetype)
+
+    f = open(path, "rb")
+    f.seek(start)
+    return Response(
+        _file_body(f, length, size),
+        status=status,
+        headers=headers,
+        mimetype=mimetype,
+        direct_passthrough=True,
+    )
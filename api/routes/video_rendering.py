@@ -1,40 +1,34 @@
 from flask import Blueprint, jsonify, current_app, request, Response
-import subprocess
 import os
-import re
 import json
+import subprocess
 import sys
 import traceback
-import shutil
 from typing import Union
 import uuid
 import time
 import requests
+from utils.render_jobs import RenderJobQueue
+from utils.manim_workers import kill_process_group, launch_manim
+from utils.progress_reader import ProgressReader
+from utils.workspace import job_workspace
+from utils.segment_render import (
+    RENDER_SEGMENT_WORKERS,
+    count_animations,
+    render_segments,
+)
+from utils.render_cache import RENDER_CACHE_ENABLED, RenderCache, render_cache_key
+from utils.storage import content_addressed_name, get_storage
+from utils.admission import Overloaded, Slot, hold_slot, manim_slots
+from utils.cancellation import Deadline, until_deadline
 
 video_rendering_bp = Blueprint("video_rendering", __name__)
 
 
-USE_LOCAL_STORAGE = os.getenv("USE_LOCAL_STORAGE", "true") == "true"
-BASE_URL = os.getenv("BASE_URL", "http://127.0.0.1:8080")
-
-
-def move_to_public_folder(
-    file_path: str, video_storage_file_name: str, base_url: Union[str, None] = None
-) -> str:
-    """
-    Moves the video to the public folder and returns the URL.
-    """
-    public_folder = os.path.join(os.path.dirname(__file__), "public")
-    os.makedirs(public_folder, exist_ok=True)
-
-    new_file_name = f"{video_storage_file_name}.mp4"
-    new_file_path = os.path.join(public_folder, new_file_name)
-
-    shutil.move(file_path, new_file_path)
-
-    url_base = base_url if base_url else BASE_URL
-    video_url = f"{url_base.rstrip('/')}/public/{new_file_name}"
-    return video_url
+DRAFT_SHORT_SIDE = int(os.getenv("DRAFT_SHORT_SIDE", "480"))
+DRAFT_FRAME_RATE = int(os.getenv("DRAFT_FRAME_RATE", "15"))
+MANIM_RENDER_TIMEOUT = float(os.getenv("MANIM_RENDER_TIMEOUT", "1800"))
+RENDER_MAX_QUEUED = int(os.getenv("RENDER_MAX_QUEUED", "100"))
 
 
 def get_frame_config(aspect_ratio):
@@ -48,207 +42,348 @@ def get_frame_config(aspect_ratio):
         return (3840, 2160), 14.22
 
 
-@video_rendering_bp.route("/v1/video/rendering", methods=["POST"])
-def render_video():
-    code = request.json.get("code")
-    file_name = request.json.get("file_name")
-    file_class = request.json.get("file_class")
-
-    user_id = request.json.get("user_id") or str(uuid.uuid4())
-    project_name = request.json.get("project_name")
-    iteration = request.json.get("iteration")
-
-    aspect_ratio = request.json.get("aspect_ratio")
-    stream = request.json.get("stream", False)
-
-    video_storage_file_name = f"video-{user_id}-{project_name}-{iteration}"
-
-    if not code:
-        return jsonify(error="No code provided"), 400
-
-    frame_size, frame_width = get_frame_config(aspect_ratio)
+def get_draft_frame_config(aspect_ratio):
+    """
+    Returns the frame config for a quick preview render: the same framing as the
+    final video, scaled down so its short side is DRAFT_SHORT_SIDE pixels.
+    """
+    (width, height), frame_width = get_frame_config(aspect_ratio)
+    scale = DRAFT_SHORT_SIDE / min(width, height)
+    # Video encoders need even dimensions
+    draft_size = (round(width * scale / 2) * 2, round(height * scale / 2) * 2)
+    return draft_size, frame_width
+
+
+def render_scene(
+    code: str,
+    file_class: Union[str, None],
+    aspect_ratio: Union[str, None],
+    video_storage_file_name: str,
+    base_url: Union[str, None] = None,
+    use_cache: bool = True,
+    draft: bool = False,
+    parallel: bool = False,
+    deadline: Union[Deadline, None] = None,
+):
+    """
+    Renders a Manim scene and yields progress events as dicts.
+
+    Events are `{"animationIndex", "percentage"}` while rendering, then either
+    `{"video_url"}` or `{"error"}`. Identical scenes are served from the render
+    cache without running manim. With `draft`, renders at low resolution and
+    DRAFT_FRAME_RATE instead of the full quality. With `parallel`, splits the
+    scene into animation segments rendered by separate processes; their progress
+    events also carry a `segment` index. Manim is killed when the generator is
+    closed (e.g. the client disconnected) or when `deadline` passes.
+    """
+    scene_class = file_class or "GenScene"
+    timeout = (
+        deadline.timeout(MANIM_RENDER_TIMEOUT) if deadline else MANIM_RENDER_TIMEOUT
+    )
+
+    if draft:
+        frame_size, frame_width = get_draft_frame_config(aspect_ratio)
+        frame_rate = DRAFT_FRAME_RATE
+    else:
+        frame_size, frame_width = get_frame_config(aspect_ratio)
+        frame_rate = None
+
+    cache_key = None
+    if RENDER_CACHE_ENABLED and use_cache:
+        cache_key = render_cache_key(
+            code, scene_class, frame_size, frame_width, frame_rate
+        )
+        video_url = None
+        try:
+            cached_path = render_cache.get(cache_key)
+            if cached_path:
+                print(f"Render cache hit: {cache_key}")
+                video_url = get_storage().save(
+                    cached_path,
+                    content_addressed_name(
+                        cached_path, f"{video_storage_file_name}.mp4"
+                    ),
+                    base_url,
+                    keep_source=True,
+                )
+        except Exception as e:
+            # E.g. the entry was evicted meanwhile: render the scene again
+            print(f"Error serving cached render {cache_key}: {str(e)}")
+            traceback.print_exc()
+        if video_url:
+            yield {"video_url": video_url}
+            return
 
+    frame_rate_config = f"config.frame_rate = {frame_rate}" if frame_rate else ""
     modified_code = f"""
 from manim import *
 from math import *
 config.frame_size = {frame_size}
 config.frame_width = {frame_width}
+{frame_rate_config}
 
 {code}
     """
 
-    file_name = f"scene_{os.urandom(2).hex()}.py"
-    api_dir = os.path.dirname(os.path.dirname(__file__))
-    public_dir = os.path.join(api_dir, "public")
-    os.makedirs(public_dir, exist_ok=True)
-    file_path = os.path.join(public_dir, file_name)
+    with job_workspace("render-") as workspace:
+        file_path = os.path.join(workspace, f"scene_{os.urandom(2).hex()}.py")
+        process = None
+        started_at = time.time()
 
-    with open(file_path, "w") as f:
-        f.write(modified_code)
+        with open(file_path, "w") as f:
+            f.write(modified_code)
 
-    def render_video():
+        extra_slots = []
         try:
-            command_list = [
-                "manim",
-                file_path,
-                file_class,
-                "--format=mp4",
-                "--media_dir",
-                ".",
-                "--custom_folders",
-            ]
-
-            process = subprocess.Popen(
-                command_list,
-                stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE,
-                cwd=os.path.dirname(os.path.realpath(__file__)),
-                text=True,
-                bufsize=1,
-            )
-            current_animation = -1
-            current_percentage = 0
-            error_output = []
-            in_error = False
-
-            while True:
-                output = process.stdout.readline()
-                error = process.stderr.readline()
-
-                if output == "" and error == "" and process.poll() is not None:
-                    break
-
-                if output:
-                    print("STDOUT:", output.strip())
-                if error:
-                    print("STDERR:", error.strip())
-                    error_output.append(error.strip())
-
-                if "is not in the script" in error:
-                    in_error = True
-                    continue
-
-                if "Traceback (most recent call last)" in error:
-                    in_error = True
-                    continue
-
-                if in_error:
-                    if error.strip() == "":
-                        in_error = False
-                        full_error = "\n".join(error_output)
-                        yield f'{{"error": {json.dumps(full_error)}}}\n'
+            num_animations = 0
+            if parallel and RENDER_SEGMENT_WORKERS > 1:
+                # The caller holds one slot; every other segment needs a free slot
+                # of its own, so a parallel render stays within MANIM_MAX_CONCURRENCY
+                extra_slots = manim_slots.try_admit(RENDER_SEGMENT_WORKERS - 1)
+                if extra_slots:
+                    try:
+                        num_animations = count_animations(
+                            file_path, scene_class, workspace, timeout
+                        )
+                    except subprocess.CalledProcessError as e:
+                        # The scene fails before rendering anything: report
+                        # manim's error like a failed render does
+                        yield {"error": e.stderr}
                         return
-                    continue
-
-                animation_match = re.search(r"Animation (\d+):", error)
-                if animation_match:
-                    new_animation = int(animation_match.group(1))
-                    if new_animation != current_animation:
-                        current_animation = new_animation
-                        current_percentage = 0
-                        yield f'{{"animationIndex": {current_animation}, "percentage": 0}}\n'
-
-                percentage_match = re.search(r"(\d+)%", error)
-                if percentage_match:
-                    new_percentage = int(percentage_match.group(1))
-                    if new_percentage != current_percentage:
-                        current_percentage = new_percentage
-                        yield f'{{"animationIndex": {current_animation}, "percentage": {current_percentage}}}\n'
-
-            if process.returncode == 0:
-                video_file_path = os.path.join(
-                    os.path.dirname(os.path.realpath(__file__)),
-                    f"{file_class or 'GenScene'}.mp4",
-                )
 
-                if not os.path.exists(video_file_path):
-                    video_file_path = os.path.join(
-                        os.path.dirname(os.path.dirname(os.path.realpath(__file__))),
-                        f"{file_class or 'GenScene'}.mp4",
-                    )
-
-                if os.path.exists(video_file_path):
-                    print(f"Video file found at: {video_file_path}")
-                else:
-                    print(
-                        f"Video file not found. Files in current directory: {os.listdir(os.path.dirname(video_file_path))}"
-                    )
-                    raise FileNotFoundError(
-                        f"Video file not found at {video_file_path}"
-                    )
-
-                print(
-                    f"Files in video file directory: {os.listdir(os.path.dirname(video_file_path))}"
+            if num_animations > 1:
+                video_file_path = yield from render_segments(
+                    file_path,
+                    scene_class,
+                    workspace,
+                    num_animations,
+                    workers=1 + len(extra_slots),
+                    timeout=timeout,
                 )
+                if video_file_path is None:
+                    return
+            else:
+                manim_args = [
+                    file_path,
+                    scene_class,
+                    "--format=mp4",
+                    "--media_dir",
+                    ".",
+                    "--custom_folders",
+                ]
+
+                process = launch_manim(manim_args, cwd=workspace, timeout=timeout)
+                progress = ProgressReader(process)
+                for event in progress:
+                    yield event
+                    if "error" in event:
+                        return
+                process.wait()
 
-                base_url = (
-                    request.host_url
-                    if request and hasattr(request, "host_url")
-                    else None
-                )
-                video_url = move_to_public_folder(
-                    video_file_path, video_storage_file_name, base_url
-                )
-                print(f"Video URL: {video_url}")
-                if stream:
-                    yield f'{{ "video_url": "{video_url}" }}\n'
-                    sys.stdout.flush()
-                else:
+                if process.timed_out:
                     yield {
-                        "message": "Video generation completed",
-                        "video_url": video_url,
+                        "error": f"Rendering took longer than the {timeout:.0f}s limit"
                     }
+                    return
+                if process.returncode != 0:
+                    full_error = "\n".join(progress.error_output)
+                    yield {"error": full_error}
+                    return
+
+                video_file_path = os.path.join(workspace, f"{scene_class}.mp4")
+
+            if os.path.exists(video_file_path):
+                print(
+                    f"Video file found at: {video_file_path} (rendered in {time.time() - started_at:.1f}s)"
+                )
             else:
-                full_error = "\n".join(error_output)
-                yield f'{{"error": {json.dumps(full_error)}}}\n'
+                print(
+                    f"Video file not found. Files in workspace: {os.listdir(workspace)}"
+                )
+                raise FileNotFoundError(f"Video file not found at {video_file_path}")
+
+            if cache_key:
+                render_cache.put(cache_key, video_file_path)
+
+            video_url = get_storage().save(
+                video_file_path,
+                content_addressed_name(
+                    video_file_path, f"{video_storage_file_name}.mp4"
+                ),
+                base_url,
+            )
+            print(f"Video URL: {video_url}")
+            yield {"video_url": video_url}
 
         except Exception as e:
             print(f"Unexpected error: {str(e)}")
             traceback.print_exc()
-            print(f"Files in current directory after error: {os.listdir('.')}")
-            yield f'{{"error": "Unexpected error occurred: {str(e)}"}}\n'
+            yield {"error": f"Unexpected error occurred: {str(e)}"}
         finally:
-            try:
-                if os.path.exists(file_path):
-                    os.remove(file_path)
-                    print(f"Removed temporary file: {file_path}")
-                if os.path.exists(video_file_path):
-                    os.remove(video_file_path)
-                    print(f"Removed temporary video file: {video_file_path}")
-            except Exception as e:
-                print(f"Error removing temporary file {file_path}: {e}")
-
-    if stream:
-        return Response(render_video(), content_type="text/event-stream", status=207)
+            if process:
+                kill_process_group(process)
+            for slot in extra_slots:
+                slot.release()
+
+
+def render_progressive(
+    render_args: dict, slot: Slot, deadline: Union[Deadline, None] = None
+):
+    """
+    Renders a fast, low-quality draft and streams its URL as `draft_video_url`, then
+    queues the full-quality render and streams its progress and final `video_url`.
+
+    The final render runs on the render job workers, so it completes even if the
+    client disconnects; the `job_id` event lets the client poll for it later.
+    `slot` is released as soon as the draft is done so the queued render can use it.
+    """
+    draft_args = {
+        **render_args,
+        "video_storage_file_name": f"{render_args['video_storage_file_name']}-draft",
+        "draft": True,
+        "deadline": deadline,
+    }
+    for event in render_scene(**draft_args):
+        if "video_url" in event:
+            yield {"draft_video_url": event["video_url"]}
+        elif "error" in event:
+            yield event
+            return
+        else:
+            yield {**event, "draft": True}
+    slot.release()
+
+    job_id = render_jobs.enqueue(render_args)
+    yield {"job_id": job_id}
+
+    last_progress = None
+    for job in render_jobs.events(job_id):
+        if "error" in job and "status" not in job:
+            yield job
+            return
+        if job["progress"] and job["progress"] != last_progress:
+            last_progress = job["progress"]
+            yield last_progress
+        if job["status"] == "completed":
+            yield {"video_url": job["video_url"]}
+        elif job["status"] == "failed":
+            yield {"error": job["error"]}
+
+
+def render_queued(**render_args):
+    """
+    Render function of the job workers: waits for a manim slot, then renders.
+    """
+    with manim_slots.admit(wait=True):
+        yield from render_scene(**render_args)
+
+
+render_cache = RenderCache(
+    os.getenv(
+        "RENDER_CACHE_DIR",
+        os.path.join(
+            os.path.dirname(os.path.dirname(__file__)), "instance", "render_cache"
+        ),
+    )
+)
+
+render_jobs = RenderJobQueue(
+    os.getenv(
+        "RENDER_JOBS_DB",
+        os.path.join(
+            os.path.dirname(os.path.dirname(__file__)), "instance", "render_jobs.db"
+        ),
+    ),
+    render_fn=render_queued,
+)
+
+
+@video_rendering_bp.route("/v1/video/rendering", methods=["POST"])
+def render_video():
+    code = request.json.get("code")
+    file_name = request.json.get("file_name")
+    file_class = request.json.get("file_class")
+
+    user_id = request.json.get("user_id") or str(uuid.uuid4())
+    project_name = request.json.get("project_name")
+    iteration = request.json.get("iteration")
+
+    aspect_ratio = request.json.get("aspect_ratio")
+    stream = request.json.get("stream", False)
+    run_async = request.json.get("async", False)
+    progressive = request.json.get("progressive", False)
+    parallel = request.json.get("parallel", False)
+    use_cache = request.json.get("cache", True)
+
+    video_storage_file_name = f"video-{user_id}-{project_name}-{iteration}"
+
+    if not code:
+        return jsonify(error="No code provided"), 400
+
+    render_args = {
+        "code": code,
+        "file_class": file_class,
+        "aspect_ratio": aspect_ratio,
+        "video_storage_file_name": video_storage_file_name,
+        "base_url": request.host_url,
+        "use_cache": use_cache,
+        "parallel": parallel,
+    }
+
+    # Progressive renders queue their full-quality render too, so they are
+    # turned away before the draft rather than after it
+    if (run_async or progressive) and render_jobs.queue_depth() >= RENDER_MAX_QUEUED:
+        raise Overloaded(
+            "Too many renders are queued, please retry later",
+            manim_slots.retry_after(),
+        )
+
+    if run_async:
+        job_id = render_jobs.enqueue(render_args)
+        return (
+            jsonify(
+                {
+                    "message": "Video generation queued",
+                    "job_id": job_id,
+                    "status": "queued",
+                    "status_url": f"{request.host_url.rstrip('/')}/v1/video/rendering/jobs/{job_id}",
+                }
+            ),
+            202,
+        )
+
+    slot = manim_slots.admit()
+    deadline = Deadline()
+
+    def render_video():
+        events = (
+            render_progressive(render_args, slot, deadline)
+            if progressive
+            else render_scene(**render_args, deadline=deadline)
+        )
+        for event in hold_slot(slot, until_deadline(events, deadline)):
+            yield f"{json.dumps(event)}\n"
+            if "video_url" in event:
+                sys.stdout.flush()
+
+    if stream or progressive:
+        response = Response(
+            render_video(), content_type="text/event-stream", status=207
+        )
+        # Also covers clients that disconnect before the stream starts
+        response.call_on_close(slot.release)
+        return response
     else:
-        video_url = None
         try:
-            for result in render_video():
-                print(f"Generated result: {result}")
-                if isinstance(result, dict):
+            video_url = None
+            with slot:
+                for result in render_scene(**render_args, deadline=deadline):
+                    print(f"Generated result: {result}")
                     if "video_url" in result:
                         video_url = result["video_url"]
                     elif "error" in result:
                         raise Exception(result["error"])
 
-            if video_url:
-                return (
-                    jsonify(
-                        {
-                            "message": "Video generation completed",
-                            "video_url": video_url,
-                        }
-                    ),
-                    200,
-                )
-            else:
-                return (
-                    jsonify(
-                        {"message": "Video generation completed, but no URL was found"}
-                    ),
-                    200,
-                )
-        except StopIteration:
             if video_url:
                 return (
                     jsonify(
@@ -271,6 +406,49 @@ config.frame_width = {frame_width}
             return jsonify({"error": str(e)}), 500
 
 
+@video_rendering_bp.route("/v1/video/rendering/capacity", methods=["GET"])
+def get_render_capacity():
+    return (
+        jsonify(
+            {
+                "slots": manim_slots.stats(),
+                "queue_depth": render_jobs.queue_depth(),
+                "max_queued": RENDER_MAX_QUEUED,
+                "render_workers": render_jobs.workers,
+            }
+        ),
+        200,
+    )
+
+
+@video_rendering_bp.route("/v1/video/rendering/cache", methods=["GET"])
+def get_render_cache_stats():
+    return jsonify(render_cache.stats()), 200
+
+
+@video_rendering_bp.route("/v1/video/rendering/jobs/<job_id>", methods=["GET"])
+def get_render_job(job_id):
+    job = render_jobs.get(job_id)
+    if job is None:
+        return jsonify(error="Render job not found"), 404
+    return jsonify(job), 200
+
+
+@video_rendering_bp.route("/v1/video/rendering/jobs/<job_id>/events", methods=["GET"])
+def stream_render_job(job_id):
+    """
+    Streams the job state as newline-delimited JSON until it completes or fails.
+    """
+    if render_jobs.get(job_id) is None:
+        return jsonify(error="Render job not found"), 404
+
+    def job_events():
+        for job in render_jobs.events(job_id):
+            yield f"{json.dumps(job)}\n"
+
+    return Response(job_events(), content_type="text/event-stream")
+
+
 def download_video(video_url):
     local_filename = video_url.split("/")[-1]
     response = requests.get(video_url)
@@ -1,28 +1,45 @@
 import os
+from dotenv import load_dotenv
+
+# Before the routes and utils imports, which read their settings at import time
+load_dotenv()
+
 from flask import Flask, send_from_directory
 from flask_cors import CORS
-from dotenv import load_dotenv
-from routes.video_rendering import video_rendering_bp
+from routes.video_rendering import video_rendering_bp, render_jobs
 from routes.chat_generation import chat_generation_bp
+from routes.media import media_bp
+from utils.storage import PUBLIC_FOLDER
+from utils.admission import Overloaded, overloaded_response
+from utils.manim_workers import warm_up as warm_up_manim
 
 
 def create_app():
-    app = Flask(__name__, static_folder="public", static_url_path="/public")
-
-    load_dotenv()
+    # Files in public/ are served by the media blueprint rather than Flask's
+    # static handler, so they get range, ETag and cache support tuned for video
+    app = Flask(__name__, static_folder=None)
 
     app.register_blueprint(video_rendering_bp)
     app.register_blueprint(chat_generation_bp)
+    app.register_blueprint(media_bp)
+
+    app.register_error_handler(Overloaded, overloaded_response)
 
     CORS(app)
 
+    # Import manim once in the fork server so renders and previews start warm
+    warm_up_manim()
+
+    # Resume any render jobs left in the queue by a previous run
+    render_jobs.start()
+
     @app.route("/")
     def hello_world():
         return "Generative Manim Processor"
 
     @app.route("/openapi.yaml")
     def openapi():
-        return send_from_directory(app.static_folder, "openapi.yaml")
+        return send_from_directory(PUBLIC_FOLDER, "openapi.yaml")
 
     return app
 
@@ -0,0 +1,62 @@
+"""
+Compares wall-clock time of the single-process and parallel segment render paths.
+
+Usage (from the api directory):
+
+    python -m scripts.benchmark_parallel_render [path/to/scene.py] [SceneClass]
+
+Without arguments it renders a built-in scene with 24 animations. Both runs
+bypass the render cache.
+"""
+
+import sys
+import time
+
+from routes.video_rendering import render_scene
+from utils.segment_render import RENDER_SEGMENT_WORKERS
+
+
+SAMPLE_SCENE = """
+class GenScene(Scene):
+    def construct(self):
+        square = Square(color=BLUE)
+        self.play(Create(square))
+        for i in range(22):
+            self.play(square.animate.rotate(PI / 4).shift(RIGHT * (0.2 if i % 2 else -0.2)))
+        self.play(FadeOut(square))
+"""
+
+
+def run(code: str, file_class: str, parallel: bool) -> float:
+    started_at = time.time()
+    for event in render_scene(
+        code,
+        file_class,
+        "16:9",
+        f"benchmark-{'parallel' if parallel else 'single'}",
+        use_cache=False,
+        parallel=parallel,
+    ):
+        if "error" in event:
+            raise RuntimeError(event["error"])
+    return time.time() - started_at
+
+
+def main():
+    if len(sys.argv) > 2:
+        with open(sys.argv[1]) as f:
+            code = f.read()
+        file_class = sys.argv[2]
+    else:
+        code, file_class = SAMPLE_SCENE, "GenScene"
+
+    single = run(code, file_class, parallel=False)
+    parallel = run(code, file_class, parallel=True)
+
+    print(f"Single process: {single:.1f}s")
+    print(f"Parallel ({RENDER_SEGMENT_WORKERS} workers): {parallel:.1f}s")
+    print(f"Speedup: {single / parallel:.2f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,90 @@
+import json
+from utils import prompt_cache
+from utils.history_compaction import compact_history
+from utils.prompt_cache import cached_messages
+
+
+def _tool_turn(n: int) -> list:
+    tool_use_id = f"toolu_{n}"
+    return [
+        {
+            "role": "assistant",
+            "content": [
+                {"type": "text", "text": f"Version {n} of the scene"},
+                {
+                    "type": "tool_use",
+                    "id": tool_use_id,
+                    "name": "get_preview",
+                    "input": {"code": f"class GenScene(Scene): pass  # {n}"},
+                },
+            ],
+        },
+        {
+            "role": "user",
+            "content": [
+                {
+                    "type": "tool_result",
+                    "tool_use_id": tool_use_id,
+                    "content": [
+                        {
+                            "type": "image",
+                            "source": {
+                                "type": "base64",
+                                "media_type": "image/png",
+                                "data": f"frame-{n}-{i}",
+                            },
+                        }
+                        for i in range(3)
+                    ],
+                }
+            ],
+        },
+    ]
+
+
+def _breakpoint(messages: list) -> int:
+    for i, message in enumerate(messages):
+        content = message["content"]
+        if isinstance(content, list) and any("cache_control" in b for b in content):
+            return i
+    raise AssertionError("no cache breakpoint")
+
+
+def _blocks(content) -> list:
+    # A string content is the same prompt as a single text block
+    if isinstance(content, str):
+        return [{"type": "text", "text": content}]
+    return [
+        {k: v for k, v in block.items() if k != "cache_control"} for block in content
+    ]
+
+
+def _serialized(messages: list) -> str:
+    return json.dumps(
+        [{**message, "content": _blocks(message["content"])} for message in messages]
+    )
+
+
+def test_cached_prefix_is_stable_across_preview_loop(monkeypatch):
+    monkeypatch.setattr(prompt_cache, "ANTHROPIC_PROMPT_CACHING", True)
+    history = [{"role": "user", "content": "Animate a circle turning into a square"}]
+    previous = None
+    for n in range(4):
+        sent = cached_messages(compact_history(history))
+        end = _breakpoint(sent) + 1
+        if previous is not None:
+            sent_before, end_before = previous
+            assert end >= end_before
+            assert _serialized(sent[:end_before]) == _serialized(
+                sent_before[:end_before]
+            )
+        previous = (sent, end)
+        history += _tool_turn(n)
+
+
+def test_breakpoint_skips_the_latest_preview(monkeypatch):
+    monkeypatch.setattr(prompt_cache, "ANTHROPIC_PROMPT_CACHING", True)
+    history = [{"role": "user", "content": "Animate a circle"}] + _tool_turn(0)
+    sent = cached_messages(compact_history(history))
+    assert _breakpoint(sent) == 1
+    assert "cache_control" not in json.dumps(sent[2])
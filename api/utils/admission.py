@@ -0,0 +1,207 @@
+import fcntl
+import math
+import os
+import random
+import threading
+import time
+from typing import Iterable, Iterator, List, Union
+
+from flask import jsonify
+
+
+MANIM_MAX_CONCURRENCY = int(os.getenv("MANIM_MAX_CONCURRENCY", os.cpu_count() or 1))
+MANIM_MAX_BACKLOG = int(os.getenv("MANIM_MAX_BACKLOG", "16"))
+MANIM_QUEUE_TIMEOUT = float(os.getenv("MANIM_QUEUE_TIMEOUT", "30"))
+# One lock file per slot, shared by every process of the node (gunicorn workers)
+MANIM_SLOTS_DIR = os.getenv("MANIM_SLOTS_DIR") or os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+    "instance",
+    "manim_slots",
+)
+# How often a waiter checks for slots freed by other processes
+MANIM_SLOT_POLL_SECONDS = float(os.getenv("MANIM_SLOT_POLL_SECONDS", "0.2"))
+
+
+class Overloaded(Exception):
+    """
+    Raised when a job cannot get a manim slot; `retry_after` is a hint in seconds.
+    """
+
+    def __init__(self, message: str, retry_after: int):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+def overloaded_response(e: Overloaded):
+    response = jsonify(error=str(e), retry_after=e.retry_after)
+    response.status_code = 429
+    response.headers["Retry-After"] = str(e.retry_after)
+    return response
+
+
+class Slot:
+    """
+    A held manim slot: an exclusive lock on one of the slot files. Releasing it
+    more than once is a no-op.
+    """
+
+    def __init__(self, controller: "AdmissionController", fd: int):
+        self._controller = controller
+        self._fd = fd
+        self._started_at = time.monotonic()
+        self._released = False
+
+    def release(self):
+        if not self._released:
+            self._released = True
+            os.close(self._fd)
+            self._controller._release(time.monotonic() - self._started_at)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
+
+
+class AdmissionController:
+    """
+    Bounds how many manim jobs run at once and how many may wait for a slot.
+
+    The `max_concurrency` slots are lock files in `slots_dir`, so the limit holds
+    for the whole node, across all the processes serving the app; a slot is
+    freed when its holder releases it or dies. Waiting and the backlog are per
+    process: waiters are woken by releases in their own process and poll for
+    slots freed by the others.
+
+    Jobs beyond `max_backlog` waiters are rejected immediately, and waiters that do
+    not get a slot within `queue_timeout` seconds are rejected too, so overload
+    turns into a fast 429 instead of requests piling up until they time out.
+    """
+
+    def __init__(
+        self,
+        max_concurrency: int = MANIM_MAX_CONCURRENCY,
+        max_backlog: int = MANIM_MAX_BACKLOG,
+        queue_timeout: float = MANIM_QUEUE_TIMEOUT,
+        slots_dir: str = MANIM_SLOTS_DIR,
+    ):
+        self.max_concurrency = max(1, max_concurrency)
+        self.max_backlog = max_backlog
+        self.queue_timeout = queue_timeout
+        self.slots_dir = slots_dir
+        self.running = 0
+        self.waiting = 0
+        self.rejected = 0
+        self._average_duration = 30.0
+        self._condition = threading.Condition()
+        os.makedirs(slots_dir, exist_ok=True)
+
+    def _take_slot(self) -> Union[Slot, None]:
+        # Called with the condition held; returns None when the node is full
+        indices = list(range(self.max_concurrency))
+        random.shuffle(indices)
+        for index in indices:
+            fd = os.open(
+                os.path.join(self.slots_dir, f"slot-{index}.lock"),
+                os.O_RDWR | os.O_CREAT,
+                0o644,
+            )
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                os.close(fd)
+                continue
+            self.running += 1
+            return Slot(self, fd)
+        return None
+
+    def retry_after(self) -> int:
+        """
+        Estimates how long until a new job would get a slot.
+        """
+        return max(
+            1,
+            math.ceil(
+                self._average_duration * (self.waiting + 1) / self.max_concurrency
+            ),
+        )
+
+    def admit(self, wait: bool = False) -> Slot:
+        """
+        Takes a slot, waiting for one if the backlog has room. With `wait`, waits
+        as long as needed and ignores the backlog limit (for internal workers).
+        """
+        with self._condition:
+            if not self.waiting and (slot := self._take_slot()):
+                return slot
+
+            if not wait and self.waiting >= self.max_backlog:
+                self.rejected += 1
+                raise Overloaded(
+                    "Too many animations are being rendered, please retry later",
+                    self.retry_after(),
+                )
+
+            self.waiting += 1
+            try:
+                deadline = None if wait else time.monotonic() + self.queue_timeout
+                while not (slot := self._take_slot()):
+                    timeout = MANIM_SLOT_POLL_SECONDS
+                    if not wait:
+                        remaining = deadline - time.monotonic()
+                        if remaining <= 0:
+                            self.rejected += 1
+                            raise Overloaded(
+                                "Timed out waiting for a free render slot, please retry later",
+                                self.retry_after(),
+                            )
+                        timeout = min(timeout, remaining)
+                    self._condition.wait(timeout)
+                return slot
+            finally:
+                self.waiting -= 1
+
+    def try_admit(self, count: int) -> List[Slot]:
+        """
+        Takes up to `count` slots that are free right now, without waiting. Takes
+        none while jobs are waiting, so extra work never delays queued jobs.
+        """
+        with self._condition:
+            slots = []
+            while not self.waiting and len(slots) < count:
+                slot = self._take_slot()
+                if slot is None:
+                    break
+                slots.append(slot)
+            return slots
+
+    def _release(self, duration: float):
+        with self._condition:
+            self.running -= 1
+            self._average_duration = 0.8 * self._average_duration + 0.2 * duration
+            self._condition.notify()
+
+    def stats(self) -> dict:
+        with self._condition:
+            return {
+                "running": self.running,
+                "waiting": self.waiting,
+                "max_concurrency": self.max_concurrency,
+                "max_backlog": self.max_backlog,
+                "rejected": self.rejected,
+                "retry_after": self.retry_after(),
+            }
+
+
+def hold_slot(slot: Slot, events: Iterable) -> Iterator:
+    """
+    Yields from `events` and releases `slot` once they are exhausted or abandoned.
+    """
+    try:
+        yield from events
+    finally:
+        slot.release()
+
+
+manim_slots = AdmissionController()
@@ -0,0 +1,95 @@
+import os
+import time
+from typing import AsyncIterator, Iterable, Iterator, Union
+
+
+# Wall-clock budget of a streaming request, after which it is cancelled; 0 disables it
+REQUEST_DEADLINE_SECONDS = float(os.getenv("REQUEST_DEADLINE_SECONDS", "1800"))
+
+
+class DeadlineExceeded(Exception):
+    pass
+
+
+class Deadline:
+    """
+    Point in time after which a request stops doing work.
+    """
+
+    def __init__(self, seconds: float = REQUEST_DEADLINE_SECONDS):
+        self.seconds = seconds
+        self.expires_at = time.monotonic() + seconds if seconds > 0 else None
+
+    def remaining(self) -> Union[float, None]:
+        if self.expires_at is None:
+            return None
+        return max(0.0, self.expires_at - time.monotonic())
+
+    def expired(self) -> bool:
+        return self.remaining() == 0.0
+
+    @property
+    def message(self) -> str:
+        return f"The request took longer than the {self.seconds:.0f}s limit"
+
+    def check(self):
+        if self.expired():
+            raise DeadlineExceeded(self.message)
+
+    def timeout(self, limit: Union[float, None] = None) -> Union[float, None]:
+        """
+        Returns the smaller of `limit` and the time left, for use as a timeout.
+        """
+        remaining = self.remaining()
+        if remaining is None:
+            return limit
+        if limit is None:
+            return remaining
+        return min(limit, remaining)
+
+
+def closing_stream(stream, deadline: Union[Deadline, None] = None) -> Iterator:
+    """
+    Iterates an LLM response stream and closes its HTTP connection as soon as
+    iteration stops, whether it finished, raised, or the consuming generator was
+    closed because the client disconnected. Raises `DeadlineExceeded` once the
+    deadline has passed, so an abandoned stream stops consuming tokens.
+    """
+    try:
+        for chunk in stream:
+            if deadline:
+                deadline.check()
+            yield chunk
+    finally:
+        stream.close()
+
+
+async def aclosing_stream(
+    stream, deadline: Union[Deadline, None] = None
+) -> AsyncIterator:
+    """
+    Async version of `closing_stream`, for the async OpenAI and Anthropic clients.
+    Also closes the stream when the task is cancelled on client disconnect.
+    """
+    try:
+        async for chunk in stream:
+            if deadline:
+                deadline.check()
+            yield chunk
+    finally:
+        await stream.close()
+
+
+def until_deadline(events: Iterable[dict], deadline: Deadline) -> Iterator[dict]:
+    """
+    Yields from an event generator until the deadline passes, then yields an
+    `{"error"}` event and closes the generator, which stops its work.
+    """
+    try:
+        for event in events:
+            yield event
+            if deadline.expired() and "video_url" not in event and "error" not in event:
+                yield {"error": deadline.message}
+                return
+    finally:
+        events.close()
@@ -0,0 +1,166 @@
+import asyncio
+import copy
+import json
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import AsyncIterator, Iterator, List, Union
+from utils.history_compaction import compact_history
+
+
+CHAT_SESSION_CACHE_SIZE = int(os.getenv("CHAT_SESSION_CACHE_SIZE", "128"))
+# Sessions not updated for this long are deleted
+CHAT_SESSION_TTL = float(os.getenv("CHAT_SESSION_TTL", str(7 * 24 * 3600)))
+
+
+class SessionStore:
+    """
+    Conversation histories keyed by session id, so clients only send the new
+    message of each turn.
+
+    Every save is written to SQLite, which is shared by all the workers, and the
+    most recently used histories are also kept in memory (an LRU of `capacity`
+    sessions). A revision id stored with each history tells whether the memory
+    copy is still current, so a hit skips decoding the stored JSON. When two
+    turns of a session run at the same time, the last one to finish wins.
+    """
+
+    def __init__(
+        self,
+        db_path: str,
+        capacity: int = CHAT_SESSION_CACHE_SIZE,
+        ttl: float = CHAT_SESSION_TTL,
+    ):
+        self.db_path = db_path
+        self.capacity = capacity
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+        os.makedirs(os.path.dirname(db_path), exist_ok=True)
+        with self._connect() as conn:
+            conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS chat_sessions (
+                    id TEXT PRIMARY KEY,
+                    revision TEXT NOT NULL,
+                    messages TEXT NOT NULL,
+                    updated_at REAL NOT NULL
+                )
+                """
+            )
+            conn.execute(
+                "CREATE INDEX IF NOT EXISTS chat_sessions_updated ON chat_sessions (updated_at)"
+            )
+
+    @contextmanager
+    def _connect(self) -> Iterator[sqlite3.Connection]:
+        conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+        try:
+            conn.execute("PRAGMA journal_mode=WAL")
+            yield conn
+        finally:
+            conn.close()
+
+    def _remember(self, session_id: str, revision: str, messages: List[dict]):
+        with self._lock:
+            self._entries[session_id] = (revision, messages)
+            self._entries.move_to_end(session_id)
+            while len(self._entries) > self.capacity:
+                self._entries.popitem(last=False)
+
+    def get(self, session_id: str) -> List[dict]:
+        """
+        Returns a copy of the session's messages, or [] for an unknown session.
+        """
+        with self._connect() as conn:
+            row = conn.execute(
+                "SELECT revision, updated_at FROM chat_sessions WHERE id = ?",
+                (session_id,),
+            ).fetchone()
+            if row is None or row[1] < time.time() - self.ttl:
+                return []
+            with self._lock:
+                entry = self._entries.get(session_id)
+                if entry is not None and entry[0] == row[0]:
+                    self._entries.move_to_end(session_id)
+                    return copy.deepcopy(entry[1])
+            row = conn.execute(
+                "SELECT revision, messages FROM chat_sessions WHERE id = ?",
+                (session_id,),
+            ).fetchone()
+        if row is None:
+            return []
+        messages = json.loads(row[1])
+        self._remember(session_id, row[0], messages)
+        return copy.deepcopy(messages)
+
+    def save(self, session_id: str, messages: List[dict]):
+        revision = uuid.uuid4().hex
+        now = time.time()
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT INTO chat_sessions (id, revision, messages, updated_at) VALUES (?, ?, ?, ?) "
+                "ON CONFLICT (id) DO UPDATE SET revision = excluded.revision, "
+                "messages = excluded.messages, updated_at = excluded.updated_at",
+                (session_id, revision, json.dumps(messages), now),
+            )
+            conn.execute(
+                "DELETE FROM chat_sessions WHERE updated_at < ?", (now - self.ttl,)
+            )
+        self._remember(session_id, revision, copy.deepcopy(messages))
+
+    def delete(self, session_id: str):
+        with self._connect() as conn:
+            conn.execute("DELETE FROM chat_sessions WHERE id = ?", (session_id,))
+        with self._lock:
+            self._entries.pop(session_id, None)
+
+
+def _history(messages: List[dict]) -> List[dict]:
+    # Stale preview frames are never sent again, so they are not stored either
+    return compact_history(
+        [message for message in messages if message.get("role") != "system"],
+        max_bytes=0,
+    )
+
+
+def saving_session(
+    events: Iterator[str],
+    store: SessionStore,
+    session_id: Union[str, None],
+    messages: List[dict],
+) -> Iterator[str]:
+    """
+    Passes `events` through, then saves `messages` (which the chat loop appends
+    the turn's replies to) as the session's history, also when the client left.
+    """
+    try:
+        yield from events
+    finally:
+        if session_id:
+            store.save(session_id, _history(messages))
+
+
+async def asaving_session(
+    events: AsyncIterator[str],
+    store: SessionStore,
+    session_id: Union[str, None],
+    messages: List[dict],
+) -> AsyncIterator[str]:
+    """
+    `saving_session` for async streams. The save runs on a thread, shielded so
+    it still completes when the stream is cancelled.
+    """
+    try:
+        async for event in events:
+            yield event
+    finally:
+        if session_id:
+            await asyncio.shield(
+                asyncio.to_thread(store.save, session_id, _history(messages))
+            )
@@ -0,0 +1,218 @@
+import json
+from typing import Tuple, Union
+
+from utils.history_compaction import PREVIEW_MARKER
+from utils.preview_engine import SINGLE_IMAGE_MAX_FRAMES, SpeculativePreview
+from utils.stream_encoder import StreamEncoder, vercel_text_frame
+
+
+PREVIEW_IMAGES_TEXT = f"""{PREVIEW_MARKER}: This message is not generated by the user, but automatically by you, the assistant when firing the `get_preview` function, this message might not be visible to the user.
+
+                                    The following images are the frames of the animation generated. Please check all the frames and follow the rules: Text should not be overlapping, the space should be used efficiently, use different colors to represent different objects, plus other improvements you can think of.
+
+                                    You can decide now if you want to iterate on the animation (if it's too complex), or just stop here and provide the final code to the user now."""
+
+
+class AnthropicReply:
+    """
+    Builds the assistant message of one streamed Anthropic reply, shared by the
+    sync and async chat loops: text deltas go through `encoder`, and a
+    `get_preview` tool call is collected until its block stops.
+    """
+
+    def __init__(self, encoder: StreamEncoder):
+        self.encoder = encoder
+        self.message = {"role": "assistant", "content": []}
+        self.text = ""
+        self.tool_use_id = None
+        self.tool_block = None
+        self.tool_json = ""
+        self.speculative_preview = SpeculativePreview(SINGLE_IMAGE_MAX_FRAMES)
+
+    def write(self, text: str) -> str:
+        self.text += text
+        return self.encoder.write(text)
+
+    def _add_text(self):
+        if self.text:
+            self.message["content"].append({"type": "text", "text": self.text})
+            self.text = ""
+
+    def start_tool_use(self, tool_use_id: str) -> str:
+        """
+        Starts a `get_preview` block and returns the buffered text frame to send
+        before the tool call runs.
+        """
+        self.tool_use_id = tool_use_id
+        self.tool_json = ""
+        self.speculative_preview = SpeculativePreview(SINGLE_IMAGE_MAX_FRAMES)
+        self._add_text()
+        self.tool_block = {
+            "type": "tool_use",
+            "id": tool_use_id,
+            "name": "get_preview",
+            "input": {},
+        }
+        self.message["content"].append(self.tool_block)
+        return self.encoder.flush()
+
+    def feed_json(self, partial_json: str):
+        self.tool_json += partial_json
+        # Renders while the rest of the call streams in
+        self.speculative_preview.feed(partial_json)
+
+    def finish_tool_use(self) -> Union[dict, None]:
+        """
+        Returns the arguments of the tool call whose block just stopped, or None
+        when the block was not a tool call. They also become the `input` of its
+        tool_use block, so the history keeps the code that was previewed.
+        """
+        if not self.tool_json:
+            return None
+        tool_json, self.tool_json = self.tool_json, ""
+        tool_call = json.loads(tool_json)
+        self.tool_block["input"] = tool_call
+        return tool_call
+
+    def finish(self) -> Tuple[str, bool]:
+        """
+        Ends the reply: returns the last buffered frame, and whether the message
+        got trailing text (and so still needs to be added to the history).
+        """
+        has_text = bool(self.text)
+        self._add_text()
+        return self.encoder.flush(), has_text
+
+
+def anthropic_tool_result(tool_use_id: str, preview_result: str) -> dict:
+    """
+    Returns the `tool_result` message for a `get_preview` call: the single image
+    of the preview (the middle frame, or the contact sheet), or the error when the
+    preview produced no frames (busy, timed out or failed).
+    """
+    preview_data = json.loads(preview_result)
+    if not preview_data.get("images"):
+        return {
+            "role": "user",
+            "content": [
+                {
+                    "type": "tool_result",
+                    "tool_use_id": tool_use_id,
+                    "is_error": True,
+                    "content": preview_data.get("error")
+                    or preview_data.get("message")
+                    or "The preview produced no frames.",
+                }
+            ],
+        }
+    middle_frame = preview_data["images"][len(preview_data["images"]) // 2]
+    return {
+        "role": "user",
+        "content": [
+            {
+                "type": "tool_result",
+                "tool_use_id": tool_use_id,
+                "content": [
+                    {
+                        "type": "image",
+                        "source": {
+                            "type": "base64",
+                            "media_type": middle_frame.get("media_type", "image/png"),
+                            "data": middle_frame["base64"],
+                        },
+                    },
+                    {"type": "text", "text": "\nPreview frame from the animation.\n"},
+                ],
+            }
+        ],
+    }
+
+
+def anthropic_preview_frames(encoder: StreamEncoder, is_for_platform: bool) -> str:
+    """
+    Returns the frames telling the client a preview was shown to the model.
+    """
+    if not is_for_platform:
+        return "\n[Preview frame]\n"
+    return (
+        encoder.write("Generated preview of the animation:\n")
+        + encoder.flush()
+        + '0:"[IMAGE: Preview frame]"\n'
+    )
+
+
+def anthropic_error_frame(error: Exception, is_for_platform: bool) -> str:
+    return vercel_text_frame(str(error)) if is_for_platform else f"Error: {str(error)}"
+
+
+def function_call_frame(function_name: str) -> str:
+    return (
+        json.dumps(
+            {
+                "type": "function_call",
+                "content": "",
+                "function_call": {"name": function_name},
+            }
+        )
+        + "\n"
+    )
+
+
+def function_call_message(reply_text: str, function_name: str, arguments: str) -> dict:
+    return {
+        "role": "assistant",
+        "content": reply_text or None,
+        "function_call": {"name": function_name, "arguments": arguments},
+    }
+
+
+def function_result_messages(preview_result: str) -> Tuple[dict, Union[dict, None]]:
+    """
+    Returns the OpenAI `function` message for a `get_preview` result, and the
+    user message carrying its frames (None when there are no frames).
+    """
+    result_json = json.loads(preview_result)
+    function_response = {
+        "content": result_json.get("message", result_json.get("error")),
+        "name": "get_preview",
+        "role": "function",
+    }
+    if not result_json.get("images"):
+        return function_response, None
+
+    image_message = {
+        "role": "user",
+        "content": [{"type": "text", "text": PREVIEW_IMAGES_TEXT}],
+    }
+    for image in result_json["images"]:
+        image_message["content"].append(
+            {
+                "type": "image_url",
+                "image_url": {
+                    "url": f"data:{image.get('media_type', 'image/png')};base64,{image['base64']}"
+                },
+            }
+        )
+    return function_response, image_message
+
+
+def function_result_frame(function_response: dict, function_name: str) -> str:
+    return (
+        json.dumps(
+            {
+                "type": "function_result",
+                "content": function_response,
+                "function_call": {"name": function_name},
+            }
+        )
+        + "\n"
+    )
+
+
+def final_frame(is_for_platform: bool) -> str:
+    """
+    The newline ending an OpenAI chat stream.
+    """
+    if is_for_platform:
+        return json.dumps({"type": "text", "text": "\n"}) + "\n"
+    return "\n"
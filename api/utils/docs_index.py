@@ -0,0 +1,131 @@
+import math
+import os
+import re
+from collections import Counter
+from typing import List
+
+from prompts.manimDocs import manimDocs
+
+
+# "retrieval" injects only the reference entries relevant to the conversation,
+# "full" injects the whole manimDocs list like before
+MANIM_DOCS_MODE = os.getenv("MANIM_DOCS_MODE", "retrieval")
+MANIM_DOCS_TOP_K = int(os.getenv("MANIM_DOCS_TOP_K", "30"))
+
+ENTRY_PATTERN = re.compile(r"^( *)- \[(.+?)\]\((.+?)\)\s*$")
+WORD_PATTERN = re.compile(r"[A-Za-z][a-z]*|[A-Z]+(?![a-z])|\d+")
+STOP_WORDS = {
+    "a",
+    "an",
+    "and",
+    "for",
+    "in",
+    "into",
+    "is",
+    "it",
+    "of",
+    "on",
+    "the",
+    "to",
+    "with",
+}
+
+
+def tokenize(text: str) -> List[str]:
+    """
+    Lowercase words, splitting identifiers like `MathTex` or `fade_in` into parts
+    and also keeping the whole identifier.
+    """
+    tokens = []
+    for identifier in re.findall(r"\w+", text):
+        parts = WORD_PATTERN.findall(identifier.replace("_", " "))
+        tokens.append(identifier.lower())
+        if len(parts) > 1:
+            tokens.extend(part.lower() for part in parts)
+    # Light stemming so that e.g. "transforms" matches `Transform`
+    return [
+        token[:-1]
+        if len(token) > 3 and token.endswith("s") and token[-2] != "s"
+        else token
+        for token in tokens
+        if token not in STOP_WORDS
+    ]
+
+
+class DocsIndex:
+    """
+    BM25 index over the entries of the Manim reference list. Each entry is
+    indexed with its own name and the names of the sections it is nested in.
+    """
+
+    def __init__(self, docs: str, k1: float = 1.2, b: float = 0.75):
+        self.k1 = k1
+        self.b = b
+        self.lines = []
+        self.terms = []
+        parents = []
+        for line in docs.splitlines():
+            match = ENTRY_PATTERN.match(line)
+            if not match:
+                continue
+            depth = len(match.group(1)) // 2
+            name = match.group(2)
+            parents = parents[:depth] + [name]
+            self.lines.append(f"- {' > '.join(parents[:-1] + [line.strip()[2:]])}")
+            # The entry's own name counts twice as much as its sections'
+            self.terms.append(
+                Counter(tokenize(" ".join(parents)) + tokenize(name.rstrip("()")))
+            )
+
+        self.lengths = [sum(terms.values()) for terms in self.terms]
+        self.average_length = sum(self.lengths) / max(1, len(self.lengths))
+        document_frequency = Counter(term for terms in self.terms for term in terms)
+        self.idf = {
+            term: math.log(1 + (len(self.terms) - df + 0.5) / (df + 0.5))
+            for term, df in document_frequency.items()
+        }
+
+    def search(self, query: str, top_k: int = MANIM_DOCS_TOP_K) -> List[int]:
+        """
+        Returns the indices of the `top_k` best matching entries, in document order.
+        """
+        query_terms = set(tokenize(query)) & self.idf.keys()
+        scores = []
+        for i, terms in enumerate(self.terms):
+            score = 0.0
+            for term in query_terms:
+                tf = terms.get(term, 0)
+                if tf:
+                    norm = self.k1 * (
+                        1 - self.b + self.b * self.lengths[i] / self.average_length
+                    )
+                    score += self.idf[term] * tf * (self.k1 + 1) / (tf + norm)
+            if score > 0:
+                scores.append((score, i))
+        best = sorted(scores, reverse=True)[:top_k]
+        return sorted(i for _, i in best)
+
+    def render(self, query: str, top_k: int = MANIM_DOCS_TOP_K) -> str:
+        hits = self.search(query, top_k)
+        if not hits:
+            return ""
+        return "\n".join(
+            [
+                "The most relevant entries of the Manim reference for this conversation (section > module > entry):",
+                "",
+                *(self.lines[i] for i in hits),
+            ]
+        )
+
+
+docs_index = DocsIndex(manimDocs)
+
+
+def manim_docs_for(query: str) -> str:
+    """
+    Returns the Manim reference to put in the system prompt for a conversation:
+    the entries matching `query`, or the full list when MANIM_DOCS_MODE is "full".
+    """
+    if MANIM_DOCS_MODE == "full":
+        return manimDocs
+    return docs_index.render(query)
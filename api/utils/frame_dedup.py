@@ -0,0 +1,60 @@
+import os
+from typing import Iterable, List, Tuple
+
+from PIL import Image
+
+from utils.frame_encoder import get_executor
+
+
+PREVIEW_DEDUP = os.getenv("PREVIEW_DEDUP", "true") == "true"
+# Max Hamming distance (out of 64 bits) for a frame to count as a duplicate
+PREVIEW_DEDUP_DISTANCE = int(os.getenv("PREVIEW_DEDUP_DISTANCE", "4"))
+
+
+def dhash(path: str) -> int:
+    """
+    Returns the 64-bit difference hash of the image at `path`: whether each pixel
+    of a 9x8 grayscale thumbnail is brighter than its right neighbour.
+    """
+    with Image.open(path) as img:
+        img.draft("L", (9, 8))
+        pixels = list(img.convert("L").resize((9, 8), Image.BILINEAR).getdata())
+
+    value = 0
+    for row in range(8):
+        for col in range(8):
+            value <<= 1
+            value |= pixels[row * 9 + col] > pixels[row * 9 + col + 1]
+    return value
+
+
+def dedup_frames(
+    frames: List[Tuple[int, str]],
+    boundaries: Iterable[int] = (),
+    max_distance: int = PREVIEW_DEDUP_DISTANCE,
+) -> List[Tuple[int, str]]:
+    """
+    Drops frames whose hash is within `max_distance` of the previous kept frame.
+
+    `frames` are sorted `(index, path)` pairs. The first and last frames are
+    always kept, and so is the last frame at or before each animation boundary.
+    """
+    if len(frames) <= 2:
+        return frames
+
+    protected = {0, len(frames) - 1}
+    position = 0
+    for boundary in sorted(boundaries):
+        while position + 1 < len(frames) and frames[position + 1][0] <= boundary:
+            position += 1
+        if frames[position][0] <= boundary:
+            protected.add(position)
+
+    hashes = list(get_executor().map(dhash, [path for _, path in frames]))
+
+    kept = [0]
+    for i in range(1, len(frames)):
+        distance = bin(hashes[i] ^ hashes[kept[-1]]).count("1")
+        if i in protected or distance > max_distance:
+            kept.append(i)
+    return [frames[i] for i in kept]
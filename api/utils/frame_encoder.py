@@ -0,0 +1,142 @@
+import base64
+import io
+import math
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import List
+
+from PIL import Image, ImageDraw
+
+
+# Codec for the preview frames sent to the models: "webp", "jpeg" or "png"
+PREVIEW_IMAGE_FORMAT = os.getenv("PREVIEW_IMAGE_FORMAT", "webp").lower()
+PREVIEW_IMAGE_QUALITY = int(os.getenv("PREVIEW_IMAGE_QUALITY", "80"))
+PREVIEW_IMAGE_SCALE = int(os.getenv("PREVIEW_IMAGE_SCALE", "4"))
+PREVIEW_ENCODE_WORKERS = int(os.getenv("PREVIEW_ENCODE_WORKERS", os.cpu_count() or 1))
+# Pack all the frames of a preview into one labelled grid image
+PREVIEW_CONTACT_SHEET = os.getenv("PREVIEW_CONTACT_SHEET", "false") == "true"
+# Longest side of the contact sheet; the Anthropic API downscales larger images
+PREVIEW_SHEET_MAX_SIDE = int(os.getenv("PREVIEW_SHEET_MAX_SIDE", "1568"))
+
+MEDIA_TYPES = {"webp": "image/webp", "jpeg": "image/jpeg", "png": "image/png"}
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def get_executor() -> ThreadPoolExecutor:
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(
+                max_workers=max(1, PREVIEW_ENCODE_WORKERS),
+                thread_name_prefix="frame-encoder",
+            )
+        return _executor
+
+
+def _downscale(img: Image.Image, size: tuple) -> Image.Image:
+    """
+    Shrinks `img` to `size`. `draft` lets JPEG sources decode straight at a
+    reduced size, and `reduce` is an integer box filter, which is several times
+    cheaper than LANCZOS and just as sharp at exact integer factors.
+    """
+    img.draft("RGB", size)
+    factor = min(img.size[0] // size[0], img.size[1] // size[1])
+    if factor > 1:
+        img = img.reduce(factor)
+    if img.size != size:
+        img = img.resize(size, Image.BILINEAR)
+    return img
+
+
+def encode_image(
+    img: Image.Image,
+    image_format: str = PREVIEW_IMAGE_FORMAT,
+    quality: int = PREVIEW_IMAGE_QUALITY,
+) -> str:
+    """
+    Encodes `img` with the preview codec and returns it base64 encoded.
+    """
+    buffer = io.BytesIO()
+    if image_format == "png":
+        img.save(buffer, format="PNG", optimize=False)
+    else:
+        if img.mode not in ("RGB", "L"):
+            img = img.convert("RGB")
+        img.save(buffer, format=image_format.upper(), quality=quality)
+    return base64.b64encode(buffer.getvalue()).decode("utf-8")
+
+
+def encode_frame(
+    path: str,
+    scale: int = PREVIEW_IMAGE_SCALE,
+    image_format: str = PREVIEW_IMAGE_FORMAT,
+    quality: int = PREVIEW_IMAGE_QUALITY,
+) -> str:
+    """
+    Downscales the frame at `path` by `scale` and returns it encoded as base64.
+    """
+    with Image.open(path) as img:
+        width, height = img.size
+        size = (max(1, width // scale), max(1, height // scale))
+        return encode_image(_downscale(img, size), image_format, quality)
+
+
+def encode_frames(paths: List[str]) -> List[str]:
+    """
+    Encodes the frames at `paths` in parallel, returning base64 strings in order.
+    PIL releases the GIL while decoding, resizing and encoding, so a thread
+    pool uses several cores.
+    """
+    if len(paths) <= 1:
+        return [encode_frame(path) for path in paths]
+    return list(get_executor().map(encode_frame, paths))
+
+
+def contact_sheet(
+    paths: List[str],
+    labels: List[str],
+    max_side: int = PREVIEW_SHEET_MAX_SIDE,
+) -> Image.Image:
+    """
+    Tiles the frames at `paths` left to right, top to bottom into one image whose
+    longest side is at most `max_side`, with each tile captioned by its label.
+    """
+    with Image.open(paths[0]) as first:
+        frame_width, frame_height = first.size
+
+    # Nearly square grid, scaled so the whole sheet fits the budget
+    columns = math.ceil(math.sqrt(len(paths)))
+    rows = math.ceil(len(paths) / columns)
+    gap = 4
+    scale = min(
+        1.0,
+        (max_side - gap * (columns + 1)) / (columns * frame_width),
+        (max_side - gap * (rows + 1)) / (rows * frame_height),
+    )
+    tile = (max(1, int(frame_width * scale)), max(1, int(frame_height * scale)))
+    sheet = Image.new(
+        "RGB",
+        (
+            columns * tile[0] + gap * (columns + 1),
+            rows * tile[1] + gap * (rows + 1),
+        ),
+        "white",
+    )
+    draw = ImageDraw.Draw(sheet)
+
+    for i, (path, label) in enumerate(zip(paths, labels)):
+        x = gap + (i % columns) * (tile[0] + gap)
+        y = gap + (i // columns) * (tile[1] + gap)
+        with Image.open(path) as img:
+            sheet.paste(_downscale(img, tile).convert("RGB"), (x, y))
+        left, top, right, bottom = draw.textbbox((x + 4, y + 4), label)
+        draw.rectangle((left - 2, top - 2, right + 2, bottom + 2), fill="black")
+        draw.text((x + 4, y + 4), label, fill="white")
+    return sheet
+
+
+def media_type(image_format: str = PREVIEW_IMAGE_FORMAT) -> str:
+    return MEDIA_TYPES.get(image_format, "image/png")
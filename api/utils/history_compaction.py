@@ -0,0 +1,123 @@
+import json
+import os
+from typing import List
+
+
+# Previews (the latest ones) whose frames are sent to the model in full
+HISTORY_KEEP_PREVIEWS = int(os.getenv("HISTORY_KEEP_PREVIEWS", "1"))
+# Older previews are reduced to a "text" note, or to a single "thumbnail" frame
+HISTORY_OLD_PREVIEWS = os.getenv("HISTORY_OLD_PREVIEWS", "text")
+# Size budget of the history sent with each model call; 0 disables it
+HISTORY_MAX_BYTES = int(os.getenv("HISTORY_MAX_BYTES", "2000000"))
+
+PREVIEW_MARKER = "ASSISTANT_MESSAGE_PREVIEW_GENERATED"
+IMAGE_TYPES = {"image_url", "image"}
+
+
+def _is_image(part) -> bool:
+    return isinstance(part, dict) and part.get("type") in IMAGE_TYPES
+
+
+def _is_tool_result(message: dict) -> bool:
+    content = message.get("content")
+    return isinstance(content, list) and any(
+        isinstance(part, dict) and part.get("type") == "tool_result" for part in content
+    )
+
+
+def _is_request(message: dict) -> bool:
+    return message.get("role") == "user" and not _is_tool_result(message)
+
+
+def is_preview_message(message: dict) -> bool:
+    """
+    Whether `message` carries preview frames: the OpenAI image message added after
+    `get_preview`, or an Anthropic `tool_result` with images.
+    """
+    content = message.get("content")
+    if message.get("role") != "user" or not isinstance(content, list):
+        return False
+    if _is_tool_result(message):
+        return any(
+            _is_image(block)
+            for part in content
+            if isinstance(part, dict) and isinstance(part.get("content"), list)
+            for block in part["content"]
+        )
+    return any(
+        isinstance(part, dict) and part.get("text", "").startswith(PREVIEW_MARKER)
+        for part in content
+    ) and any(_is_image(part) for part in content)
+
+
+def _compact_parts(parts: list, mode: str) -> list:
+    images = [part for part in parts if _is_image(part)]
+    if not images:
+        return parts
+    kept = [images[len(images) // 2]] if mode == "thumbnail" else []
+    removed = len(images) - len(kept)
+    note = {
+        "type": "text",
+        "text": f"[{removed} frame(s) of an earlier preview were removed from "
+        "the history; only the latest preview is shown in full]",
+    }
+    return [part for part in parts if not _is_image(part)] + [note] + kept
+
+
+def compact_preview(message: dict, mode: str = HISTORY_OLD_PREVIEWS) -> dict:
+    """
+    Returns a copy of a preview message without its frames, or with only the
+    middle one in "thumbnail" mode.
+    """
+    content = []
+    for part in message["content"]:
+        if part.get("type") == "tool_result" and isinstance(part.get("content"), list):
+            part = {**part, "content": _compact_parts(part["content"], mode)}
+        content.append(part)
+    if not _is_tool_result(message):
+        content = _compact_parts(content, mode)
+    return {**message, "content": content}
+
+
+def _fit_budget(messages: List[dict], max_bytes: int) -> List[dict]:
+    sizes = [len(json.dumps(message)) for message in messages]
+    total = sum(sizes)
+    start = 0
+    while start < len(messages) and messages[start].get("role") == "system":
+        start += 1
+    # The conversation's first request stays, as it states the task
+    if start < len(messages) - 1 and _is_request(messages[start]):
+        start += 1
+    first = start
+    # Drop the oldest turns after it, never the last message, and resume on a
+    # plain user message so no function/tool result is left without its call
+    while total > max_bytes and first < len(messages) - 1:
+        total -= sizes[first]
+        first += 1
+        while first < len(messages) - 1 and not _is_request(messages[first]):
+            total -= sizes[first]
+            first += 1
+    if total > max_bytes:
+        print(f"History is {total} bytes, over the {max_bytes} bytes budget")
+    return messages[:start] + messages[first:]
+
+
+def compact_history(
+    messages: List[dict],
+    keep_previews: int = HISTORY_KEEP_PREVIEWS,
+    max_bytes: int = HISTORY_MAX_BYTES,
+) -> List[dict]:
+    """
+    Returns the history to send with the next model call: only the latest
+    `keep_previews` previews keep their frames, and the oldest turns are dropped
+    while the history is over `max_bytes`. `messages` itself is left unchanged.
+    """
+    previews = [i for i, message in enumerate(messages) if is_preview_message(message)]
+    stale = set(previews[: max(0, len(previews) - keep_previews)])
+    compacted = [
+        compact_preview(message) if i in stale else message
+        for i, message in enumerate(messages)
+    ]
+    if max_bytes > 0:
+        compacted = _fit_budget(compacted, max_bytes)
+    return compacted
@@ -0,0 +1,151 @@
+import math
+import os
+import re
+from typing import List
+
+
+PREVIEW_KEYFRAME_MODE = os.getenv("PREVIEW_KEYFRAME_MODE", "stride")
+PREVIEW_FRAME_STRIDE = int(os.getenv("PREVIEW_FRAME_STRIDE", "4"))
+PREVIEW_MAX_FRAMES = int(os.getenv("PREVIEW_MAX_FRAMES", "0"))
+
+# Appended to a preview scene rendered with `--format=png`. It patches manim's
+# Cairo renderer so only the selected frames are rasterized and written; the
+# others just advance the clock. PNG names keep the original frame index, and
+# the last frame of every animation is reported as `ANIMO_BOUNDARY=<index>`.
+KEYFRAME_HOOK = """
+
+from manim.renderer.cairo_renderer import CairoRenderer as _AnimoCairoRenderer
+
+_ANIMO_STRIDE = {stride}
+_ANIMO_OFFSET = {offset}
+_ANIMO_BOUNDARIES = {boundaries}
+_ANIMO_BOUNDARY_STRIDE = {boundary_stride}
+_ANIMO_BOUNDARY_OFFSET = {boundary_offset}
+
+
+def _animo_keep(index):
+    if _ANIMO_BOUNDARIES:
+        return False
+    return index >= _ANIMO_OFFSET and (index - _ANIMO_OFFSET) % _ANIMO_STRIDE == 0
+
+
+def _animo_write(renderer, frame, index):
+    renderer.file_writer.frame_count = index
+    renderer.file_writer.write_frame(frame)
+    renderer._animo_written = True
+
+
+def _animo_add_frame(self, frame, num_frames=1):
+    if self.skip_animations:
+        return
+    self.time += num_frames / self.camera.frame_rate
+    for _ in range(num_frames):
+        index = getattr(self, "_animo_frame", 0)
+        if frame is not None and _animo_keep(index):
+            _animo_write(self, frame, index)
+        self._animo_frame = index + 1
+
+
+def _animo_render(self, scene, time, moving_mobjects):
+    if _animo_keep(getattr(self, "_animo_frame", 0)):
+        self.update_frame(scene, moving_mobjects)
+        self.add_frame(self.get_frame())
+    else:
+        self.add_frame(None)
+
+
+_animo_scene_finished = _AnimoCairoRenderer.scene_finished
+
+
+def _animo_finish(self, scene):
+    # If the counted frames overshot the render, keep at least its last frame
+    if not getattr(self, "_animo_written", False) and getattr(self, "_animo_frame", 0):
+        self.update_frame(scene)
+        _animo_write(self, self.get_frame(), self._animo_frame - 1)
+    _animo_scene_finished(self, scene)
+
+
+_AnimoCairoRenderer.add_frame = _animo_add_frame
+_AnimoCairoRenderer.render = _animo_render
+_AnimoCairoRenderer.scene_finished = _animo_finish
+
+_animo_scene_play = Scene.play
+
+
+def _animo_play(self, *args, **kwargs):
+    _animo_scene_play(self, *args, **kwargs)
+    renderer = self.renderer
+    if renderer.skip_animations or all(isinstance(a, Wait) for a in args):
+        return
+    index = getattr(renderer, "_animo_frame", 1) - 1
+    played = getattr(renderer, "_animo_boundaries", 0) + 1
+    renderer._animo_boundaries = played
+    if _ANIMO_BOUNDARIES and played % _ANIMO_BOUNDARY_STRIDE == _ANIMO_BOUNDARY_OFFSET:
+        renderer.update_frame(self)
+        _animo_write(renderer, renderer.get_frame(), index)
+    print(f"ANIMO_BOUNDARY={{index}}", flush=True)
+
+
+Scene.play = _animo_play
+"""
+
+BOUNDARY_PATTERN = re.compile(r"^ANIMO_BOUNDARY=(\d+)$", re.MULTILINE)
+
+
+def keyframe_hook(
+    stride: int = PREVIEW_FRAME_STRIDE,
+    boundaries: bool = PREVIEW_KEYFRAME_MODE == "boundaries",
+    max_frames: int = PREVIEW_MAX_FRAMES,
+    num_frames: int = 0,
+    num_animations: int = 0,
+) -> str:
+    """
+    Returns code to append to a preview scene so manim only rasterizes the frames
+    we keep: every `stride`-th frame, or with `boundaries`, one frame at the end
+    of each animation.
+
+    With `max_frames`, the stride is widened so the scene's `num_frames` (or its
+    `num_animations` with `boundaries`) give at most that many, evenly spread.
+    """
+    stride = max(1, stride)
+    offset = 0
+    boundary_stride = 1
+    boundary_offset = 0
+    if max_frames > 0:
+        if num_frames > 0 and math.ceil(num_frames / max_frames) > stride:
+            stride = math.ceil(num_frames / max_frames)
+            # Centre the kept frames, so a single one is the middle frame
+            span = (math.ceil(num_frames / stride) - 1) * stride
+            offset = (num_frames - 1 - span) // 2
+        if num_animations > 0:
+            # Count back from the last animation, as it ends on the final state
+            boundary_stride = math.ceil(num_animations / max_frames)
+            boundary_offset = num_animations % boundary_stride
+    return KEYFRAME_HOOK.format(
+        stride=stride,
+        offset=offset,
+        boundaries=boundaries,
+        boundary_stride=boundary_stride,
+        boundary_offset=boundary_offset,
+    )
+
+
+def limit_frames(items: list, max_frames: int = PREVIEW_MAX_FRAMES) -> list:
+    """
+    Keeps `max_frames` evenly spaced items (always the first and the last). The
+    hook already keeps about `max_frames` frames; this only trims the one or two
+    that frame counts rounded differently by the dry run can leave over.
+    """
+    if max_frames <= 0 or len(items) <= max_frames:
+        return items
+    if max_frames == 1:
+        return [items[len(items) // 2]]
+    step = (len(items) - 1) / (max_frames - 1)
+    return [items[round(i * step)] for i in range(max_frames)]
+
+
+def parse_boundaries(output: str) -> List[int]:
+    """
+    Returns the indices of the last frame of each animation reported by the hook.
+    """
+    return [int(index) for index in BOUNDARY_PATTERN.findall(output or "")]
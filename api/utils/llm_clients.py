@@ -0,0 +1,145 @@
+import importlib.util
+import os
+import threading
+from typing import Union
+
+import anthropic
+import httpx
+import openai
+
+
+LLM_MAX_CONNECTIONS = int(os.getenv("LLM_MAX_CONNECTIONS", "100"))
+LLM_MAX_KEEPALIVE_CONNECTIONS = int(os.getenv("LLM_MAX_KEEPALIVE_CONNECTIONS", "20"))
+LLM_KEEPALIVE_EXPIRY = float(os.getenv("LLM_KEEPALIVE_EXPIRY", "120"))
+LLM_CONNECT_TIMEOUT = float(os.getenv("LLM_CONNECT_TIMEOUT", "10"))
+LLM_READ_TIMEOUT = float(os.getenv("LLM_READ_TIMEOUT", "600"))
+# HTTP/2 needs the optional `h2` package (pip install "httpx[http2]")
+LLM_HTTP2 = os.getenv("LLM_HTTP2", "true") == "true"
+
+ENGINES = {
+    "openai": {
+        "api_key_env": "OPENAI_API_KEY",
+        "client": openai.OpenAI,
+        "async_client": openai.AsyncOpenAI,
+        "http_client": openai.DefaultHttpxClient,
+        "async_http_client": openai.DefaultAsyncHttpxClient,
+    },
+    "anthropic": {
+        "api_key_env": "ANTHROPIC_API_KEY",
+        "client": anthropic.Anthropic,
+        "async_client": anthropic.AsyncAnthropic,
+        "http_client": anthropic.DefaultHttpxClient,
+        "async_http_client": anthropic.DefaultAsyncHttpxClient,
+    },
+}
+
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+def _engine_setting(engine: str, name: str, default):
+    """
+    Per-engine override of a pool setting, e.g. ANTHROPIC_MAX_CONNECTIONS.
+    """
+    value = os.getenv(f"{engine.upper()}_{name}")
+    return type(default)(value) if value else default
+
+
+def _http_options(engine: str) -> dict:
+    http2 = _engine_setting(engine, "HTTP2", str(LLM_HTTP2).lower()) == "true"
+    if http2 and importlib.util.find_spec("h2") is None:
+        http2 = False
+    return {
+        "http2": http2,
+        "limits": httpx.Limits(
+            max_connections=_engine_setting(
+                engine, "MAX_CONNECTIONS", LLM_MAX_CONNECTIONS
+            ),
+            max_keepalive_connections=_engine_setting(
+                engine, "MAX_KEEPALIVE_CONNECTIONS", LLM_MAX_KEEPALIVE_CONNECTIONS
+            ),
+            keepalive_expiry=_engine_setting(
+                engine, "KEEPALIVE_EXPIRY", LLM_KEEPALIVE_EXPIRY
+            ),
+        ),
+        "timeout": httpx.Timeout(
+            _engine_setting(engine, "READ_TIMEOUT", LLM_READ_TIMEOUT),
+            connect=_engine_setting(engine, "CONNECT_TIMEOUT", LLM_CONNECT_TIMEOUT),
+        ),
+    }
+
+
+def _create_client(engine: str, asynchronous: bool):
+    config = ENGINES[engine]
+    options = _http_options(engine)
+    if asynchronous:
+        http_client = config["async_http_client"](**options)
+        client_class = config["async_client"]
+    else:
+        http_client = config["http_client"](**options)
+        client_class = config["client"]
+    print(
+        f"Created {'async ' if asynchronous else ''}{engine} client "
+        f"(http2={options['http2']}, max_connections={options['limits'].max_connections})"
+    )
+    return client_class(
+        api_key=os.environ.get(config["api_key_env"]), http_client=http_client
+    )
+
+
+def get_client(
+    engine: str, asynchronous: bool = False
+) -> Union[
+    openai.OpenAI, anthropic.Anthropic, openai.AsyncOpenAI, anthropic.AsyncAnthropic
+]:
+    """
+    Returns the process-wide client for `engine` ("openai" or "anthropic"),
+    creating it on first use. All requests share its connection pool, so
+    connections (and their TLS sessions) are kept alive and reused.
+
+    Async clients are bound to the event loop that first uses them, which is the
+    single server loop in the ASGI mode.
+    """
+    key = (engine, asynchronous)
+    with _clients_lock:
+        client = _clients.get(key)
+        if client is None:
+            client = _clients[key] = _create_client(engine, asynchronous)
+        return client
+
+
+def close_clients():
+    """
+    Closes the sync clients' connection pools, e.g. when a worker shuts down.
+    """
+    with _clients_lock:
+        clients = list(_clients.items())
+        _clients.clear()
+    for (_, asynchronous), client in clients:
+        if not asynchronous:
+            client.close()
+
+
+async def aclose_clients():
+    """
+    Closes every client, including the async ones, from the server's event loop.
+    """
+    with _clients_lock:
+        clients = list(_clients.items())
+        _clients.clear()
+    for (_, asynchronous), client in clients:
+        if asynchronous:
+            await client.close()
+        else:
+            client.close()
+
+
+def _forget_clients():
+    # A forked worker (e.g. gunicorn with --preload) must not share the parent's
+    # sockets, so it starts with an empty registry and opens its own pools
+    global _clients_lock
+    _clients.clear()
+    _clients_lock = threading.Lock()
+
+
+os.register_at_fork(after_in_child=_forget_clients)
@@ -0,0 +1,267 @@
+import importlib.machinery
+import multiprocessing
+import multiprocessing.connection
+import os
+import resource
+import signal
+import subprocess
+import sys
+import threading
+from typing import List, Union
+
+
+MANIM_WARM_WORKERS = os.getenv("MANIM_WARM_WORKERS", "true") == "true"
+MANIM_PRELOAD_MODULES = ["manim", "numpy", "cairo", "PIL.Image"]
+# Per-process limits for manim jobs; 0 disables a limit
+MANIM_MAX_MEMORY_MB = int(os.getenv("MANIM_MAX_MEMORY_MB", "0"))
+MANIM_MAX_CPU_SECONDS = int(os.getenv("MANIM_MAX_CPU_SECONDS", "0"))
+
+_context = None
+_context_lock = threading.Lock()
+
+
+def _get_context():
+    """
+    Returns the forkserver context used to launch warm manim processes.
+
+    The fork server is a single long-lived process that imports manim (and its
+    heavy dependencies) once. Every job is then forked from it, so it starts with
+    everything imported but with its own fresh copy of manim's global `config`.
+    """
+    global _context
+    with _context_lock:
+        if _context is None:
+            _detach_main()
+            context = multiprocessing.get_context("forkserver")
+            context.set_forkserver_preload(MANIM_PRELOAD_MODULES)
+            _context = context
+        return _context
+
+
+def _detach_main():
+    """
+    Keeps jobs from re-importing the main script. multiprocessing runs a script
+    `__main__` again as `__mp_main__` in every child, which for `python run.py`
+    would build the whole app (another fork server, more job pollers) inside each
+    manim job. Nothing the jobs run lives in `__main__`, so it gets a spec named
+    `__main__`, which multiprocessing skips, as it does for `python -m` packages.
+    """
+    main = sys.modules["__main__"]
+    if getattr(main, "__spec__", None) is None:
+        main.__spec__ = importlib.machinery.ModuleSpec("__main__", None)
+
+
+def warm_up():
+    """
+    Starts the fork server ahead of the first job so no request pays for importing manim.
+    """
+    if MANIM_WARM_WORKERS:
+        from multiprocessing import forkserver
+
+        _get_context()
+        forkserver.ensure_running()
+
+
+def apply_resource_limits():
+    """
+    Caps the current process' address space and CPU time. Runs inside the manim
+    process, right before manim starts.
+    """
+    if MANIM_MAX_MEMORY_MB:
+        limit = MANIM_MAX_MEMORY_MB * 1024 * 1024
+        resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+    if MANIM_MAX_CPU_SECONDS:
+        resource.setrlimit(
+            resource.RLIMIT_CPU, (MANIM_MAX_CPU_SECONDS, MANIM_MAX_CPU_SECONDS + 5)
+        )
+
+
+def _run_manim_cli(args: List[str], cwd: str, stdout_conn, stderr_conn):
+    """
+    Entry point of a forked job: runs the manim CLI in-process with its output
+    redirected to the parent's pipes.
+    """
+    # Lead a new process group so the job and anything it spawns can be killed at once
+    os.setsid()
+    apply_resource_limits()
+    os.dup2(stdout_conn.fileno(), 1)
+    os.dup2(stderr_conn.fileno(), 2)
+    stdout_conn.close()
+    stderr_conn.close()
+    sys.stdout = open(1, "w", buffering=1, closefd=False)
+    sys.stderr = open(2, "w", buffering=1, closefd=False)
+    os.chdir(cwd)
+
+    from manim.__main__ import main
+
+    main.main(args=args, prog_name="manim")
+
+
+class ManimProcess:
+    """
+    Handle on a manim job forked from the warm fork server.
+
+    Exposes the subset of `subprocess.Popen` used by the routes (`stdout`, `stderr`,
+    `poll`, `wait`, `returncode`, `terminate`, `kill`) so callers can use either
+    interchangeably.
+    """
+
+    def __init__(self, args: List[str], cwd: str):
+        context = _get_context()
+        stdout_r, stdout_w = context.Pipe(duplex=False)
+        stderr_r, stderr_w = context.Pipe(duplex=False)
+
+        self.args = ["manim", *args]
+        self._process = context.Process(
+            target=_run_manim_cli,
+            args=(args, cwd, stdout_w, stderr_w),
+            daemon=True,
+        )
+        self._process.start()
+        stdout_w.close()
+        stderr_w.close()
+
+        self.stdout = open(os.dup(stdout_r.fileno()), "r", buffering=1)
+        self.stderr = open(os.dup(stderr_r.fileno()), "r", buffering=1)
+        stdout_r.close()
+        stderr_r.close()
+
+    @property
+    def pid(self) -> Union[int, None]:
+        return self._process.pid
+
+    @property
+    def sentinel(self) -> int:
+        return self._process.sentinel
+
+    @property
+    def returncode(self) -> Union[int, None]:
+        return self._process.exitcode
+
+    def poll(self) -> Union[int, None]:
+        if self._process.is_alive():
+            return None
+        self._process.join()
+        return self._process.exitcode
+
+    def wait(self, timeout: Union[float, None] = None) -> int:
+        self._process.join(timeout)
+        if self._process.exitcode is None:
+            raise subprocess.TimeoutExpired(self.args, timeout)
+        return self._process.exitcode
+
+    def terminate(self):
+        self._process.terminate()
+
+    def kill(self):
+        self._process.kill()
+
+
+def kill_process_group(process: Union[ManimProcess, subprocess.Popen]):
+    """
+    Kills a running manim process together with its children (e.g. ffmpeg). Every
+    manim process leads its own process group, whose id is its pid.
+    """
+    if process.poll() is not None:
+        return
+    _kill_group(process)
+
+
+def _kill_group(process: Union[ManimProcess, subprocess.Popen]):
+    try:
+        os.killpg(process.pid, signal.SIGKILL)
+    except (ProcessLookupError, PermissionError):
+        process.kill()
+
+
+def _wait_exit(process: Union[ManimProcess, subprocess.Popen], timeout: float) -> bool:
+    """
+    Waits up to `timeout` seconds for the process to exit, without reaping a
+    forked job: only its owner joins it, since `Process.join` is not safe to call
+    from two threads at once and would report a bogus exit code to one of them.
+    """
+    if isinstance(process, ManimProcess):
+        return bool(multiprocessing.connection.wait([process.sentinel], timeout))
+    try:
+        process.wait(timeout)
+        return True
+    except subprocess.TimeoutExpired:
+        return False
+
+
+def launch_manim(
+    args: List[str], cwd: str, timeout: Union[float, None] = None
+) -> Union[ManimProcess, subprocess.Popen]:
+    """
+    Starts `manim <args>` in `cwd` with piped, line-buffered text stdout/stderr.
+
+    Uses a warm forked process when MANIM_WARM_WORKERS is enabled, otherwise a cold
+    `manim` CLI subprocess. Either way the process runs under the configured
+    resource limits, and is killed after `timeout` seconds of wall-clock time, in
+    which case its `timed_out` attribute is set.
+    """
+    if MANIM_WARM_WORKERS:
+        process = ManimProcess(args, cwd)
+    else:
+        process = subprocess.Popen(
+            ["manim", *args],
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            cwd=cwd,
+            text=True,
+            bufsize=1,
+            preexec_fn=apply_resource_limits,
+            start_new_session=True,
+        )
+
+    process.timed_out = False
+    if timeout:
+
+        def kill_on_timeout():
+            if not _wait_exit(process, timeout):
+                print(f"Killing manim after {timeout}s: {process.args}")
+                process.timed_out = True
+                # Not reaped yet (only the owner joins), so the pid is still ours
+                _kill_group(process)
+
+        threading.Thread(target=kill_on_timeout, daemon=True).start()
+    return process
+
+
+def run_manim(
+    args: List[str], cwd: str, timeout: Union[float, None] = None
+) -> subprocess.CompletedProcess:
+    """
+    Runs manim to completion, like `subprocess.run(..., check=True, capture_output=True, text=True)`.
+
+    Raises `subprocess.CalledProcessError` when manim exits with a non-zero code and
+    `subprocess.TimeoutExpired` when it is killed after `timeout` seconds.
+    """
+    process = launch_manim(args, cwd, timeout)
+    output = {}
+
+    def read(name, stream):
+        output[name] = stream.read()
+        stream.close()
+
+    readers = [
+        threading.Thread(target=read, args=("stdout", process.stdout)),
+        threading.Thread(target=read, args=("stderr", process.stderr)),
+    ]
+    for reader in readers:
+        reader.start()
+    for reader in readers:
+        reader.join()
+    returncode = process.wait()
+
+    if process.timed_out:
+        raise subprocess.TimeoutExpired(
+            process.args, timeout, output["stdout"], output["stderr"]
+        )
+    if returncode != 0:
+        raise subprocess.CalledProcessError(
+            returncode, process.args, output["stdout"], output["stderr"]
+        )
+    return subprocess.CompletedProcess(
+        process.args, returncode, output["stdout"], output["stderr"]
+    )
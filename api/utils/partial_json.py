@@ -0,0 +1,123 @@
+import json
+import re
+from typing import Dict
+
+
+STRING_END = re.compile(r'["\\]')
+NESTED_TOKEN = re.compile(r'["\\{}\[\]]')
+
+
+class StreamingJsonFields:
+    """
+    Incremental parser for a JSON object that arrives in chunks, like the
+    arguments of a streamed tool call. It collects the object's top-level
+    string fields as soon as each one is complete, without re-parsing what was
+    already seen. Other values (numbers, nested objects) are skipped.
+
+    Only meant to read the fields early: the complete text should still be
+    parsed with `json.loads` once it has arrived.
+    """
+
+    def __init__(self):
+        self.fields: Dict[str, str] = {}
+        self.done = False
+        self._text = ""
+        self._pos = 0
+        self._state = "start"
+        self._start = 0
+        self._key = None
+        self._depth = 0
+        self._in_string = False
+        self._escape = False
+
+    def feed(self, chunk: str) -> Dict[str, str]:
+        """
+        Adds the next chunk and returns the string fields it completed.
+        """
+        self._text += chunk
+        completed = {}
+        text = self._text
+        while self._pos < len(text) and not self.done:
+            state = self._state
+            char = text[self._pos]
+
+            if state in ("key", "string"):
+                # Jump to the next quote or backslash of the string
+                if self._escape:
+                    self._escape = False
+                    self._pos += 1
+                    continue
+                match = STRING_END.search(text, self._pos)
+                if match is None:
+                    self._pos = len(text)
+                    break
+                self._pos = match.end()
+                if match.group() == "\\":
+                    self._escape = True
+                    continue
+                value = json.loads(text[self._start : self._pos])
+                if state == "key":
+                    self._key = value
+                    self._state = "colon"
+                else:
+                    self.fields[self._key] = completed[self._key] = value
+                    self._state = "next"
+                continue
+
+            if state == "nested":
+                self._skip_nested()
+                continue
+
+            self._pos += 1
+            if char.isspace():
+                continue
+            if state == "start":
+                if char == "{":
+                    self._state = "next"
+            elif state == "next":
+                if char == '"':
+                    self._start = self._pos - 1
+                    self._state = "key"
+                elif char == "}":
+                    self.done = True
+            elif state == "colon":
+                if char == ":":
+                    self._state = "value"
+            elif state == "value":
+                if char == '"':
+                    self._start = self._pos - 1
+                    self._state = "string"
+                elif char in "{[":
+                    self._depth = 1
+                    self._state = "nested"
+                else:
+                    self._state = "scalar"
+            elif state == "scalar":
+                if char == ",":
+                    self._state = "next"
+                elif char == "}":
+                    self.done = True
+        return completed
+
+    def _skip_nested(self):
+        text = self._text
+        while self._pos < len(text):
+            if self._escape:
+                self._escape = False
+                self._pos += 1
+                continue
+            match = NESTED_TOKEN.search(text, self._pos)
+            if match is None:
+                self._pos = len(text)
+                return
+            self._pos = match.end()
+            token = match.group()
+            if token == "\\":
+                self._escape = self._in_string
+            elif token == '"':
+                self._in_string = not self._in_string
+            elif not self._in_string:
+                self._depth += 1 if token in "{[" else -1
+                if self._depth == 0:
+                    self._state = "next"
+                    return
@@ -0,0 +1,416 @@
+import hashlib
+import json
+import os
+import random
+import re
+import shutil
+import string
+import subprocess
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import List, Tuple
+
+from utils.admission import MANIM_MAX_CONCURRENCY, Overloaded, manim_slots
+from utils.frame_dedup import PREVIEW_DEDUP, PREVIEW_DEDUP_DISTANCE, dedup_frames
+from utils.frame_encoder import (
+    PREVIEW_IMAGE_FORMAT,
+    PREVIEW_IMAGE_QUALITY,
+    PREVIEW_IMAGE_SCALE,
+    PREVIEW_CONTACT_SHEET,
+    PREVIEW_SHEET_MAX_SIDE,
+    contact_sheet,
+    encode_frames,
+    encode_image,
+    media_type,
+)
+from utils.keyframes import (
+    PREVIEW_FRAME_STRIDE,
+    PREVIEW_KEYFRAME_MODE,
+    PREVIEW_MAX_FRAMES,
+    keyframe_hook,
+    limit_frames,
+    parse_boundaries,
+)
+from utils.manim_workers import run_manim
+from utils.segment_render import scene_counts
+from utils.partial_json import StreamingJsonFields
+from utils.storage import PUBLIC_FOLDER
+from utils.workspace import job_workspace
+
+
+MANIM_PREVIEW_TIMEOUT = float(os.getenv("MANIM_PREVIEW_TIMEOUT", "120"))
+PREVIEW_CACHE_SIZE = int(os.getenv("PREVIEW_CACHE_SIZE", "256"))
+PREVIEW_CACHE_TTL = float(os.getenv("PREVIEW_CACHE_TTL", "3600"))
+PREVIEW_QUALITY = "-pql"
+# The Anthropic chat sends the model a single image: the contact sheet, or one frame
+SINGLE_IMAGE_MAX_FRAMES = PREVIEW_MAX_FRAMES if PREVIEW_CONTACT_SHEET else 1
+# Start the preview while the model is still streaming the rest of the tool call
+PREVIEW_SPECULATIVE = os.getenv("PREVIEW_SPECULATIVE", "true") == "true"
+
+API_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def preview_cache_key(
+    code: str, class_name: str, max_frames: int = PREVIEW_MAX_FRAMES
+) -> str:
+    """
+    Hashes everything that changes the preview: the exact code (error messages
+    carry line numbers), the class name and the quality, keyframe, dedup and
+    encoding settings.
+    """
+    digest = hashlib.sha256()
+    parts = [
+        code,
+        class_name,
+        PREVIEW_QUALITY,
+        PREVIEW_KEYFRAME_MODE,
+        str(PREVIEW_FRAME_STRIDE),
+        str(max_frames),
+        PREVIEW_IMAGE_FORMAT,
+        str(PREVIEW_IMAGE_QUALITY),
+        str(PREVIEW_IMAGE_SCALE),
+        str(PREVIEW_CONTACT_SHEET),
+        str(PREVIEW_SHEET_MAX_SIDE),
+        str(PREVIEW_DEDUP),
+        str(PREVIEW_DEDUP_DISTANCE),
+    ]
+    for part in parts:
+        digest.update(part.encode("utf-8"))
+        digest.update(b"\0")
+    return digest.hexdigest()
+
+
+class PreviewCache:
+    """
+    In-memory LRU of preview results with a time-to-live, plus single-flight:
+    concurrent requests for the same key wait for the one preview in flight
+    instead of rendering it again.
+    """
+
+    def __init__(
+        self, max_entries: int = PREVIEW_CACHE_SIZE, ttl: float = PREVIEW_CACHE_TTL
+    ):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._in_flight = {}
+        self._lock = threading.Lock()
+
+    def get_or_compute(self, key: str, compute) -> str:
+        """
+        Returns the cached result for `key`, or runs `compute()` once for all
+        concurrent callers. `compute` returns `(result, cacheable)`.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and time.monotonic() - entry[0] < self.ttl:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            self._entries.pop(key, None)
+
+            future = self._in_flight.get(key)
+            if future is not None:
+                self.hits += 1
+                leader = False
+            else:
+                self.misses += 1
+                future = self._in_flight[key] = Future()
+                leader = True
+
+        if not leader:
+            return future.result()
+
+        try:
+            result, cacheable = compute()
+        except BaseException as e:
+            with self._lock:
+                del self._in_flight[key]
+            future.set_exception(e)
+            raise
+
+        with self._lock:
+            del self._in_flight[key]
+            if cacheable and self.max_entries > 0:
+                self._entries[key] = (time.monotonic(), result)
+                while len(self._entries) > self.max_entries:
+                    self._entries.popitem(last=False)
+        future.set_result(result)
+        return result
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "in_flight": len(self._in_flight),
+                "hits": self.hits,
+                "misses": self.misses,
+            }
+
+
+def _render_preview(
+    code: str, class_name: str, max_frames: int = PREVIEW_MAX_FRAMES
+) -> Tuple[str, bool]:
+    """
+    Renders the keyframes of `class_name` and returns the JSON result for the
+    model, and whether it may be cached. Busy servers, timeouts and unexpected
+    errors are transient, so only frames and manim errors are cached.
+
+    With `max_frames`, a dry run at the preview quality counts the scene's frames
+    first, so the hook only rasterizes that many. The dry run interpolates each
+    animation once instead of once per frame and rasterizes nothing, which is far
+    cheaper than rendering the frames that would be dropped.
+    """
+    print("Generating preview")
+
+    # Render in a private workspace so concurrent previews never share files
+    with job_workspace("preview-") as temp_dir:
+        # Create the Python file in the temporary location
+        file_name = f"{class_name}.py"
+        file_path = os.path.join(temp_dir, file_name)
+
+        scene_code = f"""
+from manim import *
+from math import *
+
+{code}
+"""
+
+        # Run the Manim command
+        manim_args = [
+            file_path,
+            class_name,
+            "--format=png",
+            "--media_dir",
+            temp_dir,
+            "--custom_folders",
+            PREVIEW_QUALITY,
+            "--disable_caching",
+        ]
+        try:
+            with manim_slots.admit():
+                counts = {}
+                if max_frames > 0:
+                    with open(file_path, "w") as f:
+                        f.write(scene_code)
+                    counts = scene_counts(
+                        file_path,
+                        class_name,
+                        API_DIR,
+                        MANIM_PREVIEW_TIMEOUT,
+                        flags=[PREVIEW_QUALITY],
+                    )
+                hook = keyframe_hook(
+                    max_frames=max_frames,
+                    num_frames=counts.get("frames", 0),
+                    num_animations=counts.get("boundaries", 0),
+                )
+                with open(file_path, "w") as f:
+                    f.write(scene_code + hook)
+                result = run_manim(
+                    manim_args, cwd=API_DIR, timeout=MANIM_PREVIEW_TIMEOUT
+                )
+
+            print(f"Result: {result}")
+
+            # Create the previews directory if it doesn't exist
+            previews_dir = os.path.join(PUBLIC_FOLDER, "previews")
+            os.makedirs(previews_dir, exist_ok=True)
+
+            # Generate a random string for the subfolder
+            random_string = "".join(
+                random.choices(string.ascii_letters + string.digits, k=12)
+            )
+
+            # Move the generated PNGs to the previews directory
+            source_dir = temp_dir
+            destination_dir = os.path.join(previews_dir, random_string, class_name)
+
+            # Find all PNG files in the source directory
+            png_files = [f for f in os.listdir(source_dir) if f.endswith(".png")]
+
+            if not png_files:
+                print(f"No PNG files found in: {source_dir}")
+                return (
+                    json.dumps(
+                        {
+                            "error": f"No preview files generated at expected location: {source_dir}",
+                            "images": [],
+                        }
+                    ),
+                    False,
+                )
+
+            os.makedirs(destination_dir, exist_ok=True)
+            frames = []
+            for png_file in png_files:
+                shutil.move(
+                    os.path.join(source_dir, png_file),
+                    os.path.join(destination_dir, png_file),
+                )
+                # Extract the index from the filename. Only keyframes are
+                # written, so every PNG is kept
+                match = re.search(r"(\d+)\.png$", png_file)
+                if match:
+                    frames.append(
+                        (int(match.group(1)), os.path.join(destination_dir, png_file))
+                    )
+            frames.sort()
+            if PREVIEW_DEDUP:
+                # Drop near-identical frames from static stretches (waits, slow fades)
+                frames = dedup_frames(frames, parse_boundaries(result.stdout))
+            frames = limit_frames(frames, max_frames)
+
+            if PREVIEW_CONTACT_SHEET:
+                return (
+                    json.dumps(_contact_sheet_result(frames, destination_dir)),
+                    True,
+                )
+
+            # Downscale and encode the frames in parallel
+            encoded = encode_frames([path for _, path in frames])
+            image_list = [
+                {
+                    "path": path,
+                    "index": index,
+                    "base64": base64_image,
+                    "media_type": media_type(),
+                }
+                for (index, path), base64_image in zip(frames, encoded)
+            ]
+            return (
+                json.dumps(
+                    {
+                        "message": f"Animation preview generated. Now you will see the image frames in the next automatic message...",
+                        "images": image_list,
+                    }
+                ),
+                True,
+            )
+        except Overloaded as e:
+            print(f"Preview rejected: {str(e)}")
+            return (
+                json.dumps(
+                    {
+                        "error": f"The preview server is busy. Wait and use `get_preview` again in about {e.retry_after} seconds.",
+                        "images": [],
+                    }
+                ),
+                False,
+            )
+        except subprocess.TimeoutExpired:
+            return (
+                json.dumps(
+                    {
+                        "error": f"ERROR. The preview took longer than {MANIM_PREVIEW_TIMEOUT:.0f} seconds to render. Make the animation shorter or simpler, and use `get_preview` to run the code again.",
+                        "images": [],
+                    }
+                ),
+                False,
+            )
+        except subprocess.CalledProcessError as e:
+            error_output = e.stdout + e.stderr
+            print(f"Error running Manim command: {str(e)}")
+            print(f"Command output:\n{error_output}")
+            return (
+                json.dumps(
+                    {
+                        "error": f"ERROR. Error generating preview, please think on what could be the problem, and use `get_preview` to run the code again: {str(e)}\nCommand output:\n{error_output}",
+                        "images": [],
+                    }
+                ),
+                True,
+            )
+        except Exception as e:
+            print(f"Unexpected error: {str(e)}")
+            return (
+                json.dumps({"error": f"Unexpected error: {str(e)}", "images": []}),
+                False,
+            )
+
+
+def _contact_sheet_result(frames: List[Tuple[int, str]], destination_dir: str) -> dict:
+    """
+    Packs the frames into one labelled contact sheet, so a single image carries
+    the whole timeline to the model.
+    """
+    sheet = contact_sheet(
+        [path for _, path in frames], [f"#{i + 1}" for i in range(len(frames))]
+    )
+    sheet_path = os.path.join(destination_dir, "contact_sheet.png")
+    sheet.save(sheet_path)
+    return {
+        "message": f"Animation preview generated. Now you will see {len(frames)} frames of the animation in a single image, in order from left to right and top to bottom, in the next automatic message...",
+        "images": [
+            {
+                "path": sheet_path,
+                "index": frames[0][0],
+                "frames": [index for index, _ in frames],
+                "base64": encode_image(sheet),
+                "media_type": media_type(),
+            }
+        ],
+    }
+
+
+preview_cache = PreviewCache()
+
+
+def get_preview(
+    code: str, class_name: str, max_frames: int = PREVIEW_MAX_FRAMES
+) -> str:
+    """
+    Generates PNG keyframes from a Manim scene and returns them, base64 encoded,
+    as a JSON string for the model. Identical previews are served from the cache.
+    """
+    key = preview_cache_key(code, class_name, max_frames)
+    return preview_cache.get_or_compute(
+        key, lambda: _render_preview(code, class_name, max_frames)
+    )
+
+
+_speculative_executor = None
+_speculative_executor_lock = threading.Lock()
+
+
+def start_preview(code: str, class_name: str, max_frames: int = PREVIEW_MAX_FRAMES):
+    """
+    Starts `get_preview` in the background. A later `get_preview` call with the
+    same arguments joins the running render (or hits the cache) instead of
+    starting another one.
+    """
+    global _speculative_executor
+    with _speculative_executor_lock:
+        if _speculative_executor is None:
+            _speculative_executor = ThreadPoolExecutor(
+                max_workers=max(1, MANIM_MAX_CONCURRENCY),
+                thread_name_prefix="speculative-preview",
+            )
+    print(f"Starting preview of {class_name} before the tool call is complete")
+    _speculative_executor.submit(get_preview, code, class_name, max_frames)
+
+
+class SpeculativePreview:
+    """
+    Watches the streamed arguments of a `get_preview` tool call and starts the
+    preview as soon as `code` and `class_name` are complete, so the render runs
+    while the model finishes the call.
+    """
+
+    def __init__(self, max_frames: int = PREVIEW_MAX_FRAMES):
+        self.arguments = StreamingJsonFields()
+        self.started = False
+        self.max_frames = max_frames
+
+    def feed(self, chunk: str):
+        if self.started or not PREVIEW_SPECULATIVE:
+            return
+        self.arguments.feed(chunk)
+        fields = self.arguments.fields
+        if "code" in fields and "class_name" in fields:
+            self.started = True
+            start_preview(fields["code"], fields["class_name"], self.max_frames)
@@ -0,0 +1,117 @@
+import os
+import queue
+import re
+import threading
+import time
+from typing import Iterator
+
+
+RENDER_PROGRESS_MAX_HZ = float(os.getenv("RENDER_PROGRESS_MAX_HZ", "10"))
+
+ANIMATION_PATTERN = re.compile(r"Animation (\d+):")
+PERCENTAGE_PATTERN = re.compile(r"(\d+)%")
+ERROR_MARKERS = ("is not in the script", "Traceback (most recent call last)")
+
+
+def _pump(name: str, stream, lines: queue.Queue):
+    try:
+        for line in stream:
+            lines.put((name, line))
+    except ValueError:
+        # The stream was closed while we were reading it
+        pass
+    finally:
+        lines.put((name, None))
+
+
+class ProgressReader:
+    """
+    Reads a manim process' stdout and stderr independently and yields progress events.
+
+    Each pipe is drained by its own thread, so a render that only writes to one of
+    them can never block on the other or fill up a pipe buffer. Iterating yields
+    `{"animationIndex", "percentage"}` events as soon as manim prints them, with
+    percentage updates coalesced to at most `max_rate` per second, and a final
+    `{"error"}` event if manim prints a traceback. All stderr lines are kept in
+    `error_output`.
+    """
+
+    def __init__(self, process, max_rate: float = RENDER_PROGRESS_MAX_HZ):
+        self.process = process
+        self.min_interval = 1.0 / max_rate if max_rate > 0 else 0.0
+        self.error_output = []
+        self._lines = queue.Queue()
+        for name, stream in (("stdout", process.stdout), ("stderr", process.stderr)):
+            threading.Thread(
+                target=_pump, args=(name, stream, self._lines), daemon=True
+            ).start()
+
+    def __iter__(self) -> Iterator[dict]:
+        open_streams = 2
+        current_animation = -1
+        current_percentage = 0
+        in_error = False
+        pending = None
+        last_emit = 0.0
+
+        while open_streams:
+            timeout = None
+            if pending:
+                timeout = max(0.0, last_emit + self.min_interval - time.monotonic())
+            try:
+                name, line = self._lines.get(timeout=timeout)
+            except queue.Empty:
+                yield pending
+                pending = None
+                last_emit = time.monotonic()
+                continue
+
+            if line is None:
+                open_streams -= 1
+                continue
+
+            if name == "stdout":
+                print("STDOUT:", line.strip())
+                continue
+
+            print("STDERR:", line.strip())
+            self.error_output.append(line.strip())
+
+            if any(marker in line for marker in ERROR_MARKERS):
+                in_error = True
+                continue
+
+            if in_error:
+                if line.strip() == "":
+                    yield {"error": "\n".join(self.error_output)}
+                    return
+                continue
+
+            animation_match = ANIMATION_PATTERN.search(line)
+            if animation_match:
+                new_animation = int(animation_match.group(1))
+                if new_animation != current_animation:
+                    current_animation = new_animation
+                    current_percentage = 0
+                    pending = None
+                    last_emit = time.monotonic()
+                    yield {"animationIndex": current_animation, "percentage": 0}
+
+            percentage_match = PERCENTAGE_PATTERN.search(line)
+            if percentage_match:
+                new_percentage = int(percentage_match.group(1))
+                if new_percentage != current_percentage:
+                    current_percentage = new_percentage
+                    pending = {
+                        "animationIndex": current_animation,
+                        "percentage": current_percentage,
+                    }
+                    if time.monotonic() - last_emit >= self.min_interval:
+                        yield pending
+                        pending = None
+                        last_emit = time.monotonic()
+
+        if pending:
+            yield pending
+        if in_error:
+            yield {"error": "\n".join(self.error_output)}
@@ -0,0 +1,117 @@
+import os
+import threading
+from typing import List, Union
+from utils.history_compaction import is_preview_message
+
+
+# Marks the static prompt prefix for Anthropic's prompt caching
+ANTHROPIC_PROMPT_CACHING = os.getenv("ANTHROPIC_PROMPT_CACHING", "true") == "true"
+# Rendered prompt prefixes kept in memory, one per (project, scenes)
+PROMPT_PREFIX_CACHE_SIZE = int(os.getenv("PROMPT_PREFIX_CACHE_SIZE", "128"))
+
+EPHEMERAL = {"type": "ephemeral"}
+
+
+def cached_system(system: str, prefix: str) -> Union[str, List[dict]]:
+    """
+    Splits the system prompt into its static `prefix`, marked as a cache
+    breakpoint, and the rest (the Manim reference picked for the conversation).
+    Tools come before the system prompt, so they are cached along with it.
+    """
+    if not ANTHROPIC_PROMPT_CACHING or not system.startswith(prefix):
+        return system
+    blocks = [{"type": "text", "text": prefix, "cache_control": EPHEMERAL}]
+    if rest := system[len(prefix) :].strip():
+        blocks.append({"type": "text", "text": rest})
+    return blocks
+
+
+def _stable_end(messages: List[dict]) -> int:
+    # Compaction only rewrites previews that still have their frames, so the
+    # history is stable up to the first of them (or to the end without any)
+    for i, message in enumerate(messages):
+        if is_preview_message(message):
+            return i
+    return len(messages)
+
+
+def cached_messages(messages: List[dict]) -> List[dict]:
+    """
+    Returns a copy of the compacted `messages` with a cache breakpoint on the
+    last block that the next call of the preview loop sends unchanged, so that
+    call reads the history so far from the cache. Blocks after the breakpoint
+    (the latest preview) are compacted later on and would never be read.
+    """
+    if not ANTHROPIC_PROMPT_CACHING:
+        return messages
+    for i in reversed(range(_stable_end(messages))):
+        message = messages[i]
+        content = message["content"]
+        if isinstance(content, str):
+            content = [{"type": "text", "text": content}] if content else []
+        if content:
+            content = content[:-1] + [{**content[-1], "cache_control": EPHEMERAL}]
+            return messages[:i] + [{**message, "content": content}] + messages[i + 1 :]
+    return messages
+
+
+def create_message(client, **kwargs):
+    """
+    `client.messages.create`, through the prompt caching API when it is enabled.
+    Works with both the sync and the async client.
+    """
+    if ANTHROPIC_PROMPT_CACHING:
+        return client.beta.prompt_caching.messages.create(**kwargs)
+    return client.messages.create(**kwargs)
+
+
+class PromptCacheStats:
+    """
+    Counts how much of the prompt the model calls read from the cache.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.calls = 0
+        self.hits = 0
+        self.input_tokens = 0
+        self.cache_read_input_tokens = 0
+        self.cache_creation_input_tokens = 0
+
+    def record(self, usage):
+        read = getattr(usage, "cache_read_input_tokens", None) or 0
+        created = getattr(usage, "cache_creation_input_tokens", None) or 0
+        uncached = getattr(usage, "input_tokens", None) or 0
+        with self._lock:
+            self.calls += 1
+            self.hits += 1 if read else 0
+            self.input_tokens += uncached
+            self.cache_read_input_tokens += read
+            self.cache_creation_input_tokens += created
+        print(
+            f"Prompt cache: {read} input tokens read, {created} written, "
+            f"{uncached} uncached"
+        )
+
+    def stats(self) -> dict:
+        with self._lock:
+            total = (
+                self.input_tokens
+                + self.cache_read_input_tokens
+                + self.cache_creation_input_tokens
+            )
+            return {
+                "enabled": ANTHROPIC_PROMPT_CACHING,
+                "calls": self.calls,
+                "hits": self.hits,
+                "hit_rate": self.hits / self.calls if self.calls else 0.0,
+                "input_tokens": self.input_tokens,
+                "cache_read_input_tokens": self.cache_read_input_tokens,
+                "cache_creation_input_tokens": self.cache_creation_input_tokens,
+                "token_hit_rate": (
+                    self.cache_read_input_tokens / total if total else 0.0
+                ),
+            }
+
+
+prompt_cache_stats = PromptCacheStats()
@@ -0,0 +1,140 @@
+import ast
+import hashlib
+import os
+import shutil
+import threading
+import time
+from typing import Union
+
+
+RENDER_CACHE_ENABLED = os.getenv("RENDER_CACHE_ENABLED", "true") == "true"
+RENDER_CACHE_MAX_BYTES = int(
+    os.getenv("RENDER_CACHE_MAX_BYTES", str(10 * 1024 * 1024 * 1024))
+)
+
+
+def normalize_code(code: str) -> str:
+    """
+    Returns a canonical form of the scene code so that formatting and comment
+    changes do not produce a different cache key. Falls back to the stripped
+    source when the code does not parse (the render will fail anyway).
+    """
+    try:
+        return ast.dump(ast.parse(code))
+    except (SyntaxError, ValueError):
+        return code.strip()
+
+
+def render_cache_key(
+    code: str,
+    file_class: Union[str, None],
+    frame_size: tuple,
+    frame_width: float,
+    frame_rate: Union[int, None] = None,
+) -> str:
+    digest = hashlib.sha256()
+    parts = [
+        normalize_code(code),
+        file_class or "GenScene",
+        f"{frame_size[0]}x{frame_size[1]}",
+        repr(frame_width),
+    ]
+    if frame_rate:
+        parts.append(f"{frame_rate}fps")
+    for part in parts:
+        digest.update(part.encode("utf-8"))
+        digest.update(b"\0")
+    return digest.hexdigest()
+
+
+def link_or_copy(source: str, destination: str):
+    """
+    Hardlinks `source` to `destination`, copying when they are on different filesystems.
+    """
+    if os.path.exists(destination):
+        os.remove(destination)
+    try:
+        os.link(source, destination)
+    except OSError:
+        shutil.copy2(source, destination)
+
+
+class RenderCache:
+    """
+    Content-addressed store of rendered MP4s with size-bounded LRU eviction.
+
+    Entries are `{key}.mp4` files in `cache_dir`; their mtime is bumped on every
+    hit and the oldest files are evicted once the total exceeds `max_bytes`.
+    """
+
+    def __init__(self, cache_dir: str, max_bytes: int = RENDER_CACHE_MAX_BYTES):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, f"{key}.mp4")
+
+    def get(self, key: str) -> Union[str, None]:
+        """
+        Returns the cached file path for `key`, or None on a miss.
+        """
+        path = self._path(key)
+        with self._lock:
+            if os.path.exists(path):
+                now = time.time()
+                os.utime(path, (now, now))
+                self.hits += 1
+                return path
+            self.misses += 1
+            return None
+
+    def put(self, key: str, file_path: str):
+        """
+        Adds a rendered file to the cache (as a hardlink when possible) and evicts
+        least recently used entries to stay within `max_bytes`.
+        """
+        with self._lock:
+            link_or_copy(file_path, self._path(key))
+            self._evict()
+
+    def _evict(self):
+        entries = []
+        total = 0
+        for entry in os.scandir(self.cache_dir):
+            if entry.is_file() and entry.name.endswith(".mp4"):
+                stat = entry.stat()
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+                total += stat.st_size
+
+        entries.sort()
+        for _, size, path in entries:
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+                total -= size
+                self.evictions += 1
+                print(f"Evicted cached render: {path}")
+            except OSError as e:
+                print(f"Error evicting cached render {path}: {e}")
+
+    def stats(self) -> dict:
+        with self._lock:
+            entries = [
+                entry
+                for entry in os.scandir(self.cache_dir)
+                if entry.is_file() and entry.name.endswith(".mp4")
+            ]
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "entries": len(entries),
+                "bytes": sum(entry.stat().st_size for entry in entries),
+                "max_bytes": self.max_bytes,
+            }
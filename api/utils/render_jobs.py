@@ -0,0 +1,283 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+import traceback
+import uuid
+from contextlib import contextmanager
+from typing import Callable, Iterator, Union
+
+
+RENDER_WORKERS = int(os.getenv("RENDER_WORKERS", os.cpu_count() or 1))
+# Lease of a running job; it is renewed every RENDER_JOB_HEARTBEAT_SECONDS while the
+# job runs, and a job whose lease expired (its worker died) is queued again
+RENDER_JOB_STALE_SECONDS = float(os.getenv("RENDER_JOB_STALE_SECONDS", "600"))
+RENDER_JOB_HEARTBEAT_SECONDS = float(os.getenv("RENDER_JOB_HEARTBEAT_SECONDS", "30"))
+RENDER_JOB_POLL_SECONDS = float(os.getenv("RENDER_JOB_POLL_SECONDS", "1.0"))
+
+TERMINAL_STATUSES = ("completed", "failed")
+
+
+class RenderJobQueue:
+    """
+    Durable render queue backed by SQLite, drained by a bounded pool of worker threads.
+
+    Each worker runs `render_fn(**payload)`, which must yield event dicts
+    (`animationIndex`/`percentage`, `video_url` or `error`). Jobs survive restarts:
+    anything left `queued` is picked up again. A worker claims a job with a lease
+    it keeps renewing while the job runs (also while it waits for a manim slot),
+    and only `running` jobs whose lease expired are put back in the queue. Updates
+    are made as the lease owner, so a worker that lost its job cannot overwrite
+    the result of the one that took it over.
+    """
+
+    def __init__(
+        self,
+        db_path: str,
+        render_fn: Callable[..., Iterator[dict]],
+        workers: int = RENDER_WORKERS,
+    ):
+        self.db_path = db_path
+        self.render_fn = render_fn
+        self.workers = max(1, workers)
+        self._threads = []
+        self._pid = None
+        self._instance_id = uuid.uuid4().hex[:8]
+        self._lock = threading.Lock()
+        self._wakeup = threading.Condition()
+
+        os.makedirs(os.path.dirname(db_path), exist_ok=True)
+        with self._connect() as conn:
+            conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS render_jobs (
+                    id TEXT PRIMARY KEY,
+                    status TEXT NOT NULL,
+                    payload TEXT NOT NULL,
+                    progress TEXT,
+                    video_url TEXT,
+                    error TEXT,
+                    created_at REAL NOT NULL,
+                    updated_at REAL NOT NULL
+                )
+                """
+            )
+            conn.execute(
+                "CREATE INDEX IF NOT EXISTS render_jobs_status ON render_jobs (status, created_at)"
+            )
+            columns = {row[1] for row in conn.execute("PRAGMA table_info(render_jobs)")}
+            # Databases created before leases existed
+            if "owner" not in columns:
+                conn.execute("ALTER TABLE render_jobs ADD COLUMN owner TEXT")
+            if "lease_expires_at" not in columns:
+                conn.execute("ALTER TABLE render_jobs ADD COLUMN lease_expires_at REAL")
+
+    @contextmanager
+    def _connect(self) -> Iterator[sqlite3.Connection]:
+        conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        try:
+            conn.execute("PRAGMA journal_mode=WAL")
+            yield conn
+        finally:
+            conn.close()
+
+    def start(self):
+        """
+        Starts the worker threads. Safe to call more than once; a forked process
+        (e.g. a gunicorn worker) starts its own, as threads do not survive a fork.
+        """
+        with self._lock:
+            if self._threads and self._pid == os.getpid():
+                return
+            self._threads = []
+            self._pid = os.getpid()
+            for i in range(self.workers):
+                thread = threading.Thread(
+                    target=self._worker_loop, name=f"render-worker-{i}", daemon=True
+                )
+                thread.start()
+                self._threads.append(thread)
+            print(f"Started {self.workers} render workers using {self.db_path}")
+
+    def enqueue(self, payload: dict) -> str:
+        job_id = str(uuid.uuid4())
+        now = time.time()
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT INTO render_jobs (id, status, payload, created_at, updated_at) VALUES (?, 'queued', ?, ?, ?)",
+                (job_id, json.dumps(payload), now, now),
+            )
+        self.start()
+        with self._wakeup:
+            self._wakeup.notify()
+        return job_id
+
+    def get(self, job_id: str) -> Union[dict, None]:
+        with self._connect() as conn:
+            row = conn.execute(
+                "SELECT * FROM render_jobs WHERE id = ?", (job_id,)
+            ).fetchone()
+        return self._row_to_dict(row) if row else None
+
+    def queue_depth(self) -> int:
+        with self._connect() as conn:
+            row = conn.execute(
+                "SELECT COUNT(*) FROM render_jobs WHERE status = 'queued'"
+            ).fetchone()
+        return row[0]
+
+    def events(self, job_id: str, poll_interval: float = 0.5) -> Iterator[dict]:
+        """
+        Yields the job state every time it changes, until the job finishes.
+        """
+        last = None
+        while True:
+            job = self.get(job_id)
+            if job is None:
+                yield {"error": f"Render job {job_id} not found"}
+                return
+            state = (job["status"], json.dumps(job["progress"]), job["video_url"])
+            if state != last:
+                last = state
+                yield job
+            if job["status"] in TERMINAL_STATUSES:
+                return
+            time.sleep(poll_interval)
+
+    @staticmethod
+    def _row_to_dict(row: sqlite3.Row) -> dict:
+        return {
+            "job_id": row["id"],
+            "status": row["status"],
+            "progress": json.loads(row["progress"]) if row["progress"] else None,
+            "video_url": row["video_url"],
+            "error": row["error"],
+            "created_at": row["created_at"],
+            "updated_at": row["updated_at"],
+        }
+
+    def _worker_id(self) -> str:
+        return f"{os.getpid()}-{self._instance_id}-{threading.current_thread().name}"
+
+    def _claim(self, owner: str) -> Union[sqlite3.Row, None]:
+        now = time.time()
+        with self._connect() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                # Requeue jobs whose worker died without finishing them (rows from
+                # before leases existed fall back to their last update).
+                conn.execute(
+                    "UPDATE render_jobs SET status = 'queued', owner = NULL, lease_expires_at = NULL, updated_at = ? "
+                    "WHERE status = 'running' AND (lease_expires_at < ? OR (lease_expires_at IS NULL AND updated_at < ?))",
+                    (now, now, now - RENDER_JOB_STALE_SECONDS),
+                )
+                row = conn.execute(
+                    "SELECT * FROM render_jobs WHERE status = 'queued' ORDER BY created_at LIMIT 1"
+                ).fetchone()
+                if row is not None:
+                    conn.execute(
+                        "UPDATE render_jobs SET status = 'running', owner = ?, lease_expires_at = ?, updated_at = ? WHERE id = ?",
+                        (owner, now + RENDER_JOB_STALE_SECONDS, now, row["id"]),
+                    )
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+        return row
+
+    def _update(self, job_id: str, owner: str, **fields) -> bool:
+        """
+        Updates a job this worker owns. Returns False when its lease was lost.
+        """
+        fields["updated_at"] = time.time()
+        columns = ", ".join(f"{name} = ?" for name in fields)
+        with self._connect() as conn:
+            cursor = conn.execute(
+                f"UPDATE render_jobs SET {columns} WHERE id = ? AND owner = ? AND status = 'running'",
+                (*fields.values(), job_id, owner),
+            )
+        return cursor.rowcount > 0
+
+    @contextmanager
+    def _heartbeat(self, job_id: str, owner: str):
+        """
+        Renews the job's lease in the background for as long as the block runs.
+        Stops once the job is finished or was taken over by another worker.
+        """
+        stop = threading.Event()
+
+        def renew():
+            while not stop.wait(RENDER_JOB_HEARTBEAT_SECONDS):
+                try:
+                    if not self._update(
+                        job_id,
+                        owner,
+                        lease_expires_at=time.time() + RENDER_JOB_STALE_SECONDS,
+                    ):
+                        if not stop.is_set():
+                            print(f"Render job {job_id} lost its lease")
+                        return
+                except sqlite3.Error as e:
+                    print(f"Error renewing render job {job_id}: {e}")
+
+        thread = threading.Thread(target=renew, name=f"heartbeat-{job_id}", daemon=True)
+        thread.start()
+        try:
+            yield
+        finally:
+            stop.set()
+            thread.join()
+
+    def _worker_loop(self):
+        owner = self._worker_id()
+        while True:
+            try:
+                row = self._claim(owner)
+            except sqlite3.Error as e:
+                print(f"Error claiming render job: {e}")
+                row = None
+
+            if row is None:
+                with self._wakeup:
+                    self._wakeup.wait(timeout=RENDER_JOB_POLL_SECONDS)
+                continue
+
+            with self._heartbeat(row["id"], owner):
+                self._run(row["id"], owner, json.loads(row["payload"]))
+
+    def _run(self, job_id: str, owner: str, payload: dict):
+        print(f"Render job {job_id} started")
+        video_url = None
+        try:
+            for event in self.render_fn(**payload):
+                if "error" in event:
+                    self._update(job_id, owner, status="failed", error=event["error"])
+                    print(f"Render job {job_id} failed")
+                    return
+                if "video_url" in event:
+                    video_url = event["video_url"]
+                    continue
+                if not self._update(job_id, owner, progress=json.dumps(event)):
+                    print(f"Render job {job_id} was taken over, stopping")
+                    return
+
+            if video_url:
+                self._update(job_id, owner, status="completed", video_url=video_url)
+                print(f"Render job {job_id} completed: {video_url}")
+            else:
+                self._update(
+                    job_id,
+                    owner,
+                    status="failed",
+                    error="Video generation completed, but no URL was found",
+                )
+        except Exception as e:
+            traceback.print_exc()
+            self._update(
+                job_id,
+                owner,
+                status="failed",
+                error=f"Unexpected error occurred: {str(e)}",
+            )
@@ -0,0 +1,200 @@
+import asyncio
+import hashlib
+import json
+import os
+import threading
+import time
+from typing import AsyncIterator, Callable, Iterator, List, Union
+
+
+# Opt-in: identical requests replay the recorded response instead of calling the model
+LLM_RESPONSE_CACHE_ENABLED = os.getenv("LLM_RESPONSE_CACHE_ENABLED", "false") == "true"
+LLM_RESPONSE_CACHE_MAX_BYTES = int(
+    os.getenv("LLM_RESPONSE_CACHE_MAX_BYTES", str(512 * 1024 * 1024))
+)
+LLM_RESPONSE_CACHE_TTL = float(os.getenv("LLM_RESPONSE_CACHE_TTL", str(24 * 3600)))
+
+MESSAGE_FIELDS = ("role", "content", "name", "function_call")
+
+
+def _normalize(value):
+    if isinstance(value, str):
+        return value.strip()
+    if isinstance(value, list):
+        return [_normalize(item) for item in value]
+    if isinstance(value, dict):
+        return {key: _normalize(item) for key, item in value.items()}
+    return value
+
+
+def response_cache_key(
+    engine: str, model: str, is_for_platform: bool, messages: List[dict]
+) -> str:
+    """
+    Hash of everything that decides the response: the engine and model, the
+    stream format, and the messages (system prompt included) without the
+    surrounding whitespace of their texts or fields the model never sees.
+    """
+    normalized = [
+        {
+            field: _normalize(message[field])
+            for field in MESSAGE_FIELDS
+            if field in message
+        }
+        for message in messages
+    ]
+    digest = hashlib.sha256()
+    for part in (engine, model, "platform" if is_for_platform else "raw"):
+        digest.update(part.encode("utf-8"))
+        digest.update(b"\0")
+    digest.update(
+        json.dumps(normalized, sort_keys=True, ensure_ascii=False).encode("utf-8")
+    )
+    return digest.hexdigest()
+
+
+def _turn(messages: List[dict]) -> List[dict]:
+    return [message for message in messages if message.get("role") != "system"]
+
+
+class ResponseCache:
+    """
+    Recorded chat responses on local disk, with TTL and size-bounded LRU eviction.
+
+    An entry is `{key}.json` in `cache_dir` holding the frames the response
+    streamed (already coalesced, so a replay is chunked like the original) and
+    the messages the turn added to the conversation. Its mtime is bumped on
+    every hit; entries older than `ttl` are misses and the least recently used
+    ones are evicted once the total exceeds `max_bytes`.
+    """
+
+    def __init__(
+        self,
+        cache_dir: str,
+        max_bytes: int = LLM_RESPONSE_CACHE_MAX_BYTES,
+        ttl: float = LLM_RESPONSE_CACHE_TTL,
+    ):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, f"{key}.json")
+
+    def get(self, key: str) -> Union[dict, None]:
+        path = self._path(key)
+        with self._lock:
+            try:
+                if os.path.getmtime(path) >= time.time() - self.ttl:
+                    with open(path, "r", encoding="utf-8") as f:
+                        entry = json.load(f)
+                    now = time.time()
+                    os.utime(path, (now, now))
+                    self.hits += 1
+                    return entry
+            except (OSError, ValueError):
+                pass
+            self.misses += 1
+            return None
+
+    def put(self, key: str, frames: List[str], messages: List[dict]):
+        path = self._path(key)
+        temp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with self._lock:
+            with open(temp_path, "w", encoding="utf-8") as f:
+                json.dump({"frames": frames, "messages": messages}, f)
+            os.replace(temp_path, path)
+            self._evict()
+
+    def _evict(self):
+        entries = []
+        total = 0
+        expired_before = time.time() - self.ttl
+        for entry in os.scandir(self.cache_dir):
+            if entry.is_file() and entry.name.endswith(".json"):
+                stat = entry.stat()
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+                total += stat.st_size
+
+        entries.sort()
+        for mtime, size, path in entries:
+            if total <= self.max_bytes and mtime >= expired_before:
+                break
+            try:
+                os.remove(path)
+                total -= size
+                self.evictions += 1
+            except OSError as e:
+                print(f"Error evicting cached response {path}: {e}")
+
+    def stream(
+        self, key: str, messages: List[dict], generate: Callable[[], Iterator[str]]
+    ) -> Iterator[str]:
+        """
+        Replays the cached response for `key`, adding its messages to `messages`,
+        or streams `generate()` and records it. Only turns that end with the
+        assistant's reply are recorded, so errors and cancelled streams are not.
+        """
+        entry = self.get(key)
+        if entry is not None:
+            print(f"Replaying cached response {key}")
+            messages.extend(entry["messages"])
+            yield from entry["frames"]
+            return
+
+        start = len(_turn(messages))
+        frames = []
+        for frame in generate():
+            frames.append(frame)
+            yield frame
+        turn = _turn(messages)[start:]
+        if turn and turn[-1].get("role") == "assistant":
+            self.put(key, frames, turn)
+
+    async def astream(
+        self,
+        key: str,
+        messages: List[dict],
+        generate: Callable[[], AsyncIterator[str]],
+    ) -> AsyncIterator[str]:
+        """
+        `stream` for async responses, reading and writing the cache on a thread.
+        """
+        entry = await asyncio.to_thread(self.get, key)
+        if entry is not None:
+            print(f"Replaying cached response {key}")
+            messages.extend(entry["messages"])
+            for frame in entry["frames"]:
+                yield frame
+            return
+
+        start = len(_turn(messages))
+        frames = []
+        async for frame in generate():
+            frames.append(frame)
+            yield frame
+        turn = _turn(messages)[start:]
+        if turn and turn[-1].get("role") == "assistant":
+            await asyncio.to_thread(self.put, key, frames, turn)
+
+    def stats(self) -> dict:
+        with self._lock:
+            entries = [
+                entry
+                for entry in os.scandir(self.cache_dir)
+                if entry.is_file() and entry.name.endswith(".json")
+            ]
+            return {
+                "enabled": LLM_RESPONSE_CACHE_ENABLED,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "entries": len(entries),
+                "bytes": sum(entry.stat().st_size for entry in entries),
+                "max_bytes": self.max_bytes,
+            }
@@ -0,0 +1,230 @@
+import os
+import queue
+import re
+import subprocess
+import threading
+from typing import Dict, List, Sequence, Tuple, Union
+
+from utils.manim_workers import kill_process_group, launch_manim, run_manim
+from utils.progress_reader import ProgressReader
+
+
+RENDER_SEGMENT_WORKERS = int(os.getenv("RENDER_SEGMENT_WORKERS", os.cpu_count() or 1))
+
+COUNT_PATTERN = re.compile(r"^ANIMO_NUM_(PLAYS|BOUNDARIES|FRAMES)=(\d+)$", re.MULTILINE)
+
+# Appended to the scene file for the counting pass: reports how many animations
+# (`self.play`/`self.wait` calls) the scene has once construct() has run, how
+# many of them are not waits, and how many frames the full render would have.
+COUNT_PLAYS_HOOK = """
+
+_animo_scene_render = Scene.render
+_animo_count_play = Scene.play
+
+
+def _animo_counting_play(self, *args, **kwargs):
+    _animo_count_play(self, *args, **kwargs)
+    frames = round(getattr(self, "duration", 0) * config.frame_rate)
+    self._animo_num_frames = getattr(self, "_animo_num_frames", 0) + frames
+    if not all(isinstance(a, Wait) for a in args):
+        self._animo_num_boundaries = getattr(self, "_animo_num_boundaries", 0) + 1
+
+
+def _animo_count_plays(self, *args, **kwargs):
+    result = _animo_scene_render(self, *args, **kwargs)
+    print(f"ANIMO_NUM_PLAYS={self.renderer.num_plays}", flush=True)
+    print(f"ANIMO_NUM_BOUNDARIES={getattr(self, '_animo_num_boundaries', 0)}", flush=True)
+    print(f"ANIMO_NUM_FRAMES={getattr(self, '_animo_num_frames', 0)}", flush=True)
+    return result
+
+
+Scene.play = _animo_counting_play
+Scene.render = _animo_count_plays
+"""
+
+
+def scene_counts(
+    file_path: str,
+    file_class: str,
+    cwd: str,
+    timeout: Union[float, None] = None,
+    flags: Sequence[str] = (),
+) -> Dict[str, int]:
+    """
+    Runs the scene with `--dry_run` (nothing is rasterized or encoded) and returns
+    its number of animations ("plays"), of animations that are not waits
+    ("boundaries") and of frames ("frames"). The frame count is at the frame rate
+    set by `flags`, so pass the quality flags of the render it is for. When manim
+    fails, its output is logged and the `CalledProcessError` (which carries it)
+    is raised.
+    """
+    with open(file_path) as f:
+        code = f.read()
+    count_path = f"{os.path.splitext(file_path)[0]}_count.py"
+    with open(count_path, "w") as f:
+        f.write(code + COUNT_PLAYS_HOOK)
+
+    try:
+        result = run_manim(
+            [count_path, file_class, *flags, "--dry_run"], cwd=cwd, timeout=timeout
+        )
+    except subprocess.CalledProcessError as e:
+        print(f"Counting the animations of {file_class} failed:\n{e.stderr}")
+        raise
+    finally:
+        os.remove(count_path)
+
+    counts = {"plays": 0, "boundaries": 0, "frames": 0}
+    for name, value in COUNT_PATTERN.findall(result.stdout):
+        counts[name.lower()] = int(value)
+    return counts
+
+
+def count_animations(
+    file_path: str, file_class: str, cwd: str, timeout: Union[float, None] = None
+) -> int:
+    """
+    Runs the scene with `--dry_run` and returns its number of animations. The
+    count does not depend on the quality, so it runs at the lowest one, where the
+    dry run steps through the fewest frames.
+    """
+    return scene_counts(file_path, file_class, cwd, timeout, flags=["-ql"])["plays"]
+
+
+def split_animations(num_animations: int, num_segments: int) -> List[Tuple[int, int]]:
+    """
+    Splits animations 0..num_animations-1 into contiguous, inclusive (start, end)
+    ranges of nearly equal size.
+    """
+    num_segments = max(1, min(num_segments, num_animations))
+    size, remainder = divmod(num_animations, num_segments)
+    segments = []
+    start = 0
+    for i in range(num_segments):
+        end = start + size + (1 if i < remainder else 0) - 1
+        segments.append((start, end))
+        start = end + 1
+    return segments
+
+
+def concat_videos(video_paths: List[str], output_path: str):
+    """
+    Joins MP4 segments encoded with the same settings without re-encoding them.
+    """
+    list_path = f"{output_path}.txt"
+    with open(list_path, "w") as f:
+        for path in video_paths:
+            f.write(f"file '{path}'\n")
+    subprocess.run(
+        [
+            "ffmpeg",
+            "-y",
+            "-loglevel",
+            "error",
+            "-f",
+            "concat",
+            "-safe",
+            "0",
+            "-i",
+            list_path,
+            "-c",
+            "copy",
+            output_path,
+        ],
+        check=True,
+        capture_output=True,
+        text=True,
+    )
+    os.remove(list_path)
+
+
+def render_segments(
+    file_path: str,
+    file_class: str,
+    workspace: str,
+    num_animations: int,
+    workers: int = RENDER_SEGMENT_WORKERS,
+    timeout: Union[float, None] = None,
+):
+    """
+    Renders a scene as contiguous animation ranges in parallel manim processes and
+    concatenates the results.
+
+    Each process runs the whole `construct()` but only rasterizes its own range
+    (manim's `-n start,end`); earlier animations are skipped, which replays the
+    scene state deterministically. Yields progress events tagged with `segment`
+    and returns the path of the joined video, or None after yielding an error.
+    """
+    segments = split_animations(num_animations, workers)
+    events = queue.Queue()
+    processes = []
+
+    def run_segment(index, process):
+        try:
+            progress = ProgressReader(process)
+            for event in progress:
+                events.put(("event", index, event))
+            process.wait()
+            error_output = progress.error_output
+            if process.timed_out:
+                error_output = [f"Segment took longer than the {timeout:.0f}s limit"]
+            events.put(("done", index, process.returncode, error_output))
+        except Exception as e:
+            events.put(("done", index, -1, [str(e)]))
+
+    print(f"Rendering {num_animations} animations in {len(segments)} segments")
+    try:
+        segment_dirs = []
+        for index, (start, end) in enumerate(segments):
+            segment_dir = os.path.join(workspace, f"segment-{index}")
+            os.makedirs(segment_dir, exist_ok=True)
+            segment_dirs.append(segment_dir)
+
+            animation_range = (
+                f"{start}" if index == len(segments) - 1 else f"{start},{end}"
+            )
+            manim_args = [
+                file_path,
+                file_class,
+                "--format=mp4",
+                "--media_dir",
+                ".",
+                "--custom_folders",
+                "-n",
+                animation_range,
+            ]
+            process = launch_manim(manim_args, cwd=segment_dir, timeout=timeout)
+            processes.append(process)
+            threading.Thread(
+                target=run_segment, args=(index, process), daemon=True
+            ).start()
+
+        remaining = len(segments)
+        while remaining:
+            message = events.get()
+            if message[0] == "event":
+                _, index, event = message
+                yield {**event, "segment": index}
+                if "error" in event:
+                    return None
+            else:
+                _, index, returncode, error_output = message
+                if returncode != 0:
+                    yield {"error": "\n".join(error_output), "segment": index}
+                    return None
+                remaining -= 1
+
+        segment_videos = []
+        for segment_dir in segment_dirs:
+            video_path = os.path.join(segment_dir, f"{file_class}.mp4")
+            if not os.path.exists(video_path):
+                yield {"error": f"Segment video not found at {video_path}"}
+                return None
+            segment_videos.append(video_path)
+
+        output_path = os.path.join(workspace, f"{file_class}.mp4")
+        concat_videos(segment_videos, output_path)
+        return output_path
+    finally:
+        for process in processes:
+            kill_process_group(process)
@@ -0,0 +1,237 @@
+import hashlib
+import os
+import shutil
+import threading
+import uuid
+from abc import ABC, abstractmethod
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import suppress
+from typing import Union
+
+from utils.render_cache import link_or_copy
+
+
+USE_LOCAL_STORAGE = os.getenv("USE_LOCAL_STORAGE", "true") == "true"
+BASE_URL = os.getenv("BASE_URL", "http://127.0.0.1:8080")
+STORAGE_BACKEND = os.getenv(
+    "STORAGE_BACKEND", "local" if USE_LOCAL_STORAGE else "azure"
+)
+STORAGE_UPLOAD_CONCURRENCY = int(os.getenv("STORAGE_UPLOAD_CONCURRENCY", "8"))
+STORAGE_UPLOAD_BLOCK_SIZE = int(
+    os.getenv("STORAGE_UPLOAD_BLOCK_SIZE", str(8 * 1024 * 1024))
+)
+
+PUBLIC_FOLDER = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "public"
+)
+
+
+class Storage(ABC):
+    """
+    Where rendered files are published. `save` returns the public URL of the file.
+
+    With `keep_source`, the source file is left in place (e.g. when it lives in the
+    render cache); otherwise the backend may consume it.
+    """
+
+    @abstractmethod
+    def save(
+        self,
+        file_path: str,
+        file_name: str,
+        base_url: Union[str, None] = None,
+        keep_source: bool = False,
+    ) -> str:
+        pass
+
+
+class LocalStorage(Storage):
+    """
+    Publishes files to the `public/` folder served by the app, using renames and
+    hardlinks so no bytes are copied when the source is on the same filesystem.
+    """
+
+    def __init__(self, public_folder: str = PUBLIC_FOLDER):
+        self.public_folder = public_folder
+
+    def save(self, file_path, file_name, base_url=None, keep_source=False):
+        os.makedirs(self.public_folder, exist_ok=True)
+        new_file_path = os.path.join(self.public_folder, file_name)
+
+        if keep_source:
+            link_or_copy(file_path, new_file_path)
+        else:
+            shutil.move(file_path, new_file_path)
+
+        url_base = base_url if base_url else BASE_URL
+        return f"{url_base.rstrip('/')}/public/{file_name}"
+
+
+class AzureBlobStorage(Storage):
+    """
+    Uploads to an Azure Blob Storage container, streaming the file from disk in
+    STORAGE_UPLOAD_BLOCK_SIZE blocks with up to STORAGE_UPLOAD_CONCURRENCY blocks
+    in flight. Works against Azurite with `UseDevelopmentStorage=true` as the
+    connection string.
+    """
+
+    def __init__(
+        self,
+        connection_string: str,
+        container_name: str,
+        concurrency: int = STORAGE_UPLOAD_CONCURRENCY,
+        block_size: int = STORAGE_UPLOAD_BLOCK_SIZE,
+    ):
+        from azure.core.exceptions import ResourceExistsError
+        from azure.storage.blob import BlobServiceClient
+
+        self.concurrency = concurrency
+        service = BlobServiceClient.from_connection_string(
+            connection_string,
+            max_block_size=block_size,
+            max_single_put_size=block_size,
+        )
+        self.container = service.get_container_client(container_name)
+        try:
+            self.container.create_container()
+        except ResourceExistsError:
+            pass
+
+    def save(self, file_path, file_name, base_url=None, keep_source=False):
+        from azure.storage.blob import ContentSettings
+
+        content_settings = ContentSettings(content_type=_content_type(file_name))
+        with open(file_path, "rb") as f:
+            blob = self.container.upload_blob(
+                file_name,
+                f,
+                overwrite=True,
+                max_concurrency=self.concurrency,
+                content_settings=content_settings,
+            )
+        if not keep_source:
+            os.remove(file_path)
+        return self.container.get_blob_client(blob.blob_name).url
+
+
+class GoogleCloudStorage(Storage):
+    """
+    Uploads to a Google Cloud Storage bucket. Large files are split into up to
+    STORAGE_UPLOAD_CONCURRENCY byte ranges uploaded in parallel straight from
+    disk and composed into the final object. Honours STORAGE_EMULATOR_HOST for
+    local emulators.
+    """
+
+    MAX_COMPOSE_PARTS = 32
+
+    def __init__(
+        self,
+        bucket_name: str,
+        concurrency: int = STORAGE_UPLOAD_CONCURRENCY,
+        block_size: int = STORAGE_UPLOAD_BLOCK_SIZE,
+    ):
+        from google.cloud import storage
+
+        if os.getenv("STORAGE_EMULATOR_HOST"):
+            from google.auth.credentials import AnonymousCredentials
+
+            client = storage.Client(
+                credentials=AnonymousCredentials(), project="emulator"
+            )
+        else:
+            client = storage.Client()
+        self.bucket = client.bucket(bucket_name)
+        self.concurrency = max(1, min(concurrency, self.MAX_COMPOSE_PARTS))
+        self.block_size = block_size
+
+    def _upload_range(self, file_path: str, blob, offset: int, size: int):
+        with open(file_path, "rb") as f:
+            f.seek(offset)
+            blob.upload_from_file(f, size=size, rewind=False)
+
+    def save(self, file_path, file_name, base_url=None, keep_source=False):
+        file_size = os.path.getsize(file_path)
+        blob = self.bucket.blob(file_name)
+        blob.content_type = _content_type(file_name)
+
+        if file_size <= self.block_size or self.concurrency == 1:
+            blob.chunk_size = self.block_size
+            blob.upload_from_filename(file_path)
+        else:
+            from google.api_core.exceptions import NotFound
+
+            num_parts = min(self.concurrency, -(-file_size // self.block_size))
+            part_size = -(-file_size // num_parts)
+            prefix = f"_parts/{uuid.uuid4()}"
+            parts = [self.bucket.blob(f"{prefix}/{i}") for i in range(num_parts)]
+            try:
+                with ThreadPoolExecutor(max_workers=num_parts) as executor:
+                    list(
+                        executor.map(
+                            lambda i: self._upload_range(
+                                file_path,
+                                parts[i],
+                                i * part_size,
+                                min(part_size, file_size - i * part_size),
+                            ),
+                            range(num_parts),
+                        )
+                    )
+                blob.compose(parts)
+            finally:
+                # Also when an upload or the compose failed, so no parts are left
+                # behind; parts that never got uploaded do not exist
+                for part in parts:
+                    with suppress(NotFound):
+                        part.delete()
+
+        if not keep_source:
+            os.remove(file_path)
+        return blob.public_url
+
+
+def content_addressed_name(file_path: str, file_name: str) -> str:
+    """
+    Returns `file_name` with the SHA-256 of the file's bytes before its extension,
+    so the published name never points to different bytes and can be cached
+    forever.
+    """
+    with open(file_path, "rb") as f:
+        digest = hashlib.file_digest(f, "sha256").hexdigest()
+    stem, extension = os.path.splitext(file_name)
+    return f"{stem}-{digest}{extension}"
+
+
+def _content_type(file_name: str) -> str:
+    if file_name.endswith(".mp4"):
+        return "video/mp4"
+    if file_name.endswith(".png"):
+        return "image/png"
+    return "application/octet-stream"
+
+
+_storage = None
+_storage_lock = threading.Lock()
+
+
+def create_storage(backend: str = STORAGE_BACKEND) -> Storage:
+    if backend == "azure":
+        return AzureBlobStorage(
+            os.environ["AZURE_STORAGE_CONNECTION_STRING"],
+            os.environ["AZURE_STORAGE_CONTAINER_NAME"],
+        )
+    if backend == "gcs":
+        return GoogleCloudStorage(os.environ["GCS_BUCKET_NAME"])
+    return LocalStorage()
+
+
+def get_storage() -> Storage:
+    """
+    Returns the process-wide storage backend selected by STORAGE_BACKEND, creating
+    it on first use.
+    """
+    global _storage
+    with _storage_lock:
+        if _storage is None:
+            _storage = create_storage()
+        return _storage
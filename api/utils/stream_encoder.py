@@ -0,0 +1,85 @@
+import json
+import os
+import time
+from typing import Callable, Dict
+
+
+# A frame is written once this many characters are buffered...
+STREAM_COALESCE_CHARS = int(os.getenv("STREAM_COALESCE_CHARS", "256"))
+# ...or once the oldest buffered delta has waited this long
+STREAM_COALESCE_MS = float(os.getenv("STREAM_COALESCE_MS", "50"))
+
+
+def raw_frame(text: str) -> str:
+    return text
+
+
+def vercel_text_frame(text: str) -> str:
+    """
+    Text part of the Vercel AI data stream protocol: `0:<JSON string>\\n`.
+    """
+    return f"0:{json.dumps(text, ensure_ascii=False)}\n"
+
+
+def json_text_frame(text: str) -> str:
+    return json.dumps({"type": "text", "text": text}, ensure_ascii=False) + "\n"
+
+
+def json_args_frame(args: str) -> str:
+    return (
+        json.dumps(
+            {"type": "function_call", "content": "", "function_call": {"args": args}},
+            ensure_ascii=False,
+        )
+        + "\n"
+    )
+
+
+class StreamEncoder:
+    """
+    Coalesces streamed model deltas into fewer, larger frames.
+
+    `write` buffers a delta and returns the frames that are due ("" while
+    buffering); `flush` returns whatever is buffered. Each kind of delta (e.g.
+    "text", "args") has its own frame function, and switching kinds flushes the
+    previous one, so frames keep the order of the deltas. Call `flush` before
+    yielding anything else (tool calls, previews, errors) and at the end.
+    """
+
+    def __init__(
+        self,
+        frames: Dict[str, Callable[[str], str]],
+        max_chars: int = STREAM_COALESCE_CHARS,
+        max_delay: float = STREAM_COALESCE_MS / 1000,
+    ):
+        self.frames = frames
+        self.max_chars = max_chars
+        self.max_delay = max_delay
+        self._kind = None
+        self._parts = []
+        self._size = 0
+        self._since = 0.0
+
+    def write(self, delta: str, kind: str = "text") -> str:
+        if not delta:
+            return ""
+        output = self.flush() if kind != self._kind else ""
+        if not self._parts:
+            self._kind = kind
+            self._since = time.monotonic()
+        self._parts.append(delta)
+        self._size += len(delta)
+        if (
+            self._size >= self.max_chars
+            or time.monotonic() - self._since >= self.max_delay
+        ):
+            output += self.flush()
+        return output
+
+    def flush(self) -> str:
+        if not self._parts:
+            return ""
+        frame = self.frames[self._kind]("".join(self._parts))
+        self._parts = []
+        self._size = 0
+        return frame
@@ -0,0 +1,29 @@
+import os
+import shutil
+import tempfile
+from contextlib import contextmanager
+from typing import Iterator
+
+
+# Defaults to a directory next to `public/` so finished files can be moved with a
+# plain rename. Point it at a tmpfs (e.g. /dev/shm/animo) to keep scratch I/O in
+# memory; outputs are then copied out instead of renamed.
+MANIM_WORKSPACE_ROOT = os.getenv("MANIM_WORKSPACE_ROOT") or os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+    "instance",
+    "workspaces",
+)
+
+
+@contextmanager
+def job_workspace(prefix: str = "job-") -> Iterator[str]:
+    """
+    Creates a private scratch directory for one render or preview job and removes
+    it (with everything manim wrote into it) when the job is done.
+    """
+    os.makedirs(MANIM_WORKSPACE_ROOT, exist_ok=True)
+    workspace = tempfile.mkdtemp(prefix=prefix, dir=MANIM_WORKSPACE_ROOT)
+    try:
+        yield workspace
+    finally:
+        shutil.rmtree(workspace, ignore_errors=True)